@@ -13,6 +13,7 @@ def create_confgi_ini():
         config['webserver'] = {}
         config['db-update'] = {}
         config['ftp-connect'] = {}
+        config['ingest'] = {}
 
         # Запись значения в секцию и ключ
         config['global']['log-level'] = 'info'
@@ -23,6 +24,16 @@ def create_confgi_ini():
         config['webserver']['admin'] = 'admin'
         config['webserver']['admin_pass'] = '4321'
         config['webserver']['api_key'] = 'your_default_secure_key'
+        config['webserver']['fiscals-page-size'] = '200'
+        config['webserver']['search-exclude-columns'] = 'licenses'
+        config['webserver']['suggest-limit'] = '10'
+        config['webserver']['suggest-cache-ttl-sec'] = '30'
+        config['webserver']['stream-fetch-size'] = '500'
+        config['webserver']['api-max-serial-numbers'] = '20000'
+        config['webserver']['api-max-changes'] = '5000'
+        config['webserver']['api-changes-retention-days'] = '30'
+        config['webserver']['green-db'] = '1'
+        config['webserver']['socket-timeout-sec'] = '60'
         config['db-update']['reference'] = '0'
         config['db-update']['db-name'] = 'getad'
         config['db-update']['host'] = ''
@@ -31,11 +42,30 @@ def create_confgi_ini():
         config['db-update']['password'] = ''
         config['db-update']['dbupdate-period-sec'] = '900'
         config['db-update']['day_filter_expire'] = '5'
+        config['db-update']['pool-min-size'] = '1'
+        config['db-update']['pool-max-size'] = '10'
+        config['db-update']['pool-idle-timeout-sec'] = '300'
+        config['db-update']['pool-timeout-sec'] = '30'
+        config['db-update']['pool-health-check-sec'] = '30'
+        config['db-update']['pool-stream-max-size'] = '3'
+        config['db-update']['clients-update-workers'] = '8'
+        config['db-update']['clients-update-host-interval-sec'] = '1.5'
+        config['db-update']['clients-update-deadline-sec'] = '3600'
+        config['db-update']['rms-cache-ttl-sec'] = '3600'
+        config['db-update']['rms-negative-cache-ttl-sec'] = '300'
         config['ftp-connect']['ftp_backup'] = '0'
         config['ftp-connect']['ftp_update'] = '0'
         config['ftp-connect']['ftpHost'] = ''
         config['ftp-connect']['ftpUser'] = ''
         config['ftp-connect']['ftpPass'] = ''
+        config['ingest']['batch-size'] = '500'
+        config['ingest']['batch-latency-ms'] = '200'
+        config['ingest']['queue-max-size'] = '10000'
+        config['ingest']['queue-retry-after-sec'] = '5'
+        config['ingest']['durable-queue'] = '0'
+        config['ingest']['queue-workers'] = '1'
+        config['ingest']['submit-batch-max-items'] = '10000'
+        config['ingest']['submit-batch-max-bytes'] = '52428800'
 
         # Запись изменений в файл
         with open(about.config_path, 'w') as configfile:
@@ -1,32 +1,38 @@
 import core.logger
 import core.sys_manager
 import core.dbmanagement
+import core.dbpool
+import core.ingest
 import requests
+import requests.adapters
+import urllib.parse
 import time
 import ftplib
-import queue
 import threading
 import json
 import os
+import zlib
 from functools import wraps
-from flask import request, jsonify
+from flask import request, jsonify, Response, stream_with_context, current_app
 
 dbquerie = core.dbmanagement.DbQueries()
 
+
 class ApiConnector(core.sys_manager.ResourceManagement):
     def __init__(self):
         super().__init__()
-        # Создаем очередь для обработки JSON-запросов
-        self.json_queue = queue.Queue()
-        self.user_api_key = None
-        self.admin_api_key = None
+        # До загрузки ключей из БД запросы к API отклоняются
+        self.user_api_key = []
+        self.admin_api_key = []
 
         try: self.ftp_backup = int(self.config.get("ftp-connect", "ftp_backup", fallback=0))
         except: self.ftp_backup = 0
 
-        # Запускаем обработчик очереди в отдельном потоке
-        self.queue_processor = threading.Thread(target=self.process_queue, daemon=True)
-        self.queue_processor.start()
+        try: self.queue_retry_after = int(self.config.get("ingest", "queue-retry-after-sec", fallback=5))
+        except: self.queue_retry_after = 5
+
+        # Очередь JSON общая для процесса, её разбирают процессы-обработчики core.ingest
+        self.json_queue = core.ingest.ingest_pipeline.queue
 
     def update_api_keys(self):
         self.user_api_key = dbquerie.get_api_key(0)
@@ -59,37 +65,6 @@ class ApiConnector(core.sys_manager.ResourceManagement):
 
         return decorated
 
-    def process_queue(self):
-        # Обработчик очереди JSON, работает в отдельном потоке
-        while True:
-            try:
-                # Если очередь не пуста, обрабатываем данные
-                if not self.json_queue.empty():
-                    json_data = self.json_queue.get()
-                    # Проверяем тип данных: фискальный или обычный
-                    if isinstance(json_data, dict) and "serialNumber" in json_data:
-                        dbquerie.save_fiscals({json_data["serialNumber"]: json_data})
-                        filename = f"{json_data.get('serialNumber')}.json"
-                    else:
-                        teamviever_id = json_data.get("teamviewer_id")
-                        anydesk_id = json_data.get("anydesk_id")
-                        filename = f"TV{teamviever_id}_AD{anydesk_id}.json"
-                        dbquerie.save_not_fiscal(json_data, filename)
-
-                    # Подтверждаем завершение задачи
-                    self.json_queue.task_done()
-                    core.logger.connectors.info(
-                        f"Обработан JSON через API: {filename}")
-
-                    if self.ftp_backup == 1:
-                        self.ftp_upload(json_data, filename)
-                else:
-                    # Если очередь пуста, делаем небольшую паузу чтобы не загружать процессор
-                    time.sleep(0.1)
-            except Exception as e:
-                core.logger.connectors.error(f"Ошибка в обработчике очереди: {str(e)}", exc_info=True)
-                time.sleep(1)  # Пауза после ошибки
-
     def ftp_upload(self,  json_data, json_name, send_timeout=10, max_attempts=5, attempt=1):
         try:
             # Создаем временную директорию, если ее нет
@@ -128,6 +103,121 @@ class ApiConnector(core.sys_manager.ResourceManagement):
 class ApiMethod(ApiConnector):
     def __init__(self):
         super().__init__()
+        try: self.max_serial_numbers = int(self.config.get("webserver", "api-max-serial-numbers", fallback=20000))
+        except: self.max_serial_numbers = 20000
+
+        try: self.max_changes = int(self.config.get("webserver", "api-max-changes", fallback=5000))
+        except: self.max_changes = 5000
+
+        try: self.submit_batch_max_items = int(self.config.get("ingest", "submit-batch-max-items", fallback=10000))
+        except: self.submit_batch_max_items = 10000
+
+        try: self.submit_batch_max_bytes = int(self.config.get("ingest", "submit-batch-max-bytes", fallback=52428800))
+        except: self.submit_batch_max_bytes = 52428800
+
+    def requested_fields(self):
+        # ?fields=serialNumber,INN,... - список полей записей в ответе
+        fields = request.args.get('fields')
+        if not fields:
+            return None
+        return [field.strip() for field in fields.split(',') if field.strip()]
+
+    def records_response(self, records, batch_size=500):
+        # Записи отдаются потоком по мере чтения из БД: JSON-массивом или, если клиент запросил
+        # 'Accept: application/x-ndjson', по одной записи в строке
+        ndjson = request.accept_mimetypes.best_match(
+            ['application/json', 'application/x-ndjson']) == 'application/x-ndjson'
+
+        def generate():
+            # Ошибка чтения записей прерывает генератор до закрывающей ']', и ответ обрывается без
+            # завершающего блока: клиент видит, что данные получены не полностью
+            batch = [] if ndjson else ['[']
+            for index, record in enumerate(records):
+                # Сериализация с теми же настройками, что и у jsonify
+                line = current_app.json.dumps(record, separators=(',', ':'))
+                if ndjson:
+                    batch.append(line + '\n')
+                else:
+                    batch.append((',' if index else '') + line)
+
+                if len(batch) >= batch_size:
+                    yield ''.join(batch)
+                    batch = []
+
+            if not ndjson:
+                batch.append(']\n')
+            yield ''.join(batch)
+
+        return Response(stream_with_context(generate()),
+                        mimetype='application/x-ndjson' if ndjson else 'application/json')
+
+    def queue_full_response(self):
+        # Очередь заполнена: агент или ретранслятор повторяет запрос позже, данные не теряются молча
+        message = 'Ingest queue is full, retry later'
+        core.logger.connectors.warning({'status': 'error', 'message': message})
+        response = jsonify({'status': 'error', 'message': message})
+        response.headers['Retry-After'] = str(self.queue_retry_after)
+        return response, 429
+
+    def validate_submission(self, json_data):
+        # JSON от агента должен быть объектом с адресом RMS и временем формирования
+        return isinstance(json_data, dict) and "url_rms" in json_data and "current_time" in json_data
+
+    def read_request_body(self):
+        # Тело запроса с учётом 'Content-Encoding: gzip'; размер проверяется и до, и после распаковки,
+        # чтобы сжатое тело не развернулось в памяти сверх лимита
+        if request.content_length is not None and request.content_length > self.submit_batch_max_bytes:
+            raise OverflowError
+
+        # Тело читаем порциями не более лимита + 1 байт: при 'Transfer-Encoding: chunked' длина заранее
+        # неизвестна, и без ограничения чтения тело целиком оказалось бы в памяти. Для chunked-тела
+        # request.stream пуст (eventlet не выставляет wsgi.input_terminated), поэтому читаем wsgi.input,
+        # который сам разбирает порции
+        stream = request.stream
+        if request.content_length is None and 'chunked' in request.headers.get('Transfer-Encoding', '').lower():
+            stream = request.environ['wsgi.input']
+
+        limit = self.submit_batch_max_bytes + 1
+        chunks, size = [], 0
+        while size < limit:
+            chunk = stream.read(min(65536, limit - size))
+            if not chunk:
+                break
+            chunks.append(chunk)
+            size += len(chunk)
+        if size > self.submit_batch_max_bytes:
+            raise OverflowError
+
+        body = b''.join(chunks)
+        encoding = request.headers.get('Content-Encoding', '').strip().lower()
+        if encoding in ('gzip', 'x-gzip'):
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            body = decompressor.decompress(body, self.submit_batch_max_bytes + 1)
+            if len(body) > self.submit_batch_max_bytes or decompressor.unconsumed_tail:
+                raise OverflowError
+        elif encoding not in ('', 'identity'):
+            raise ValueError(f'Unsupported Content-Encoding: {encoding}')
+
+        if len(body) > self.submit_batch_max_bytes:
+            raise OverflowError
+        return body.decode('utf-8')
+
+    def parse_batch_body(self, body):
+        # Тело - JSON-массив или NDJSON (по одному JSON в строке). Возвращает список пар (запись, ошибка):
+        # в NDJSON некорректная строка отклоняется отдельно, не мешая остальным
+        if request.mimetype != 'application/x-ndjson' and body.lstrip().startswith('['):
+            items = json.loads(body)
+            return [(item, None) for item in items]
+
+        items = []
+        for line in body.splitlines():
+            if not line.strip():
+                continue
+            try:
+                items.append((json.loads(line), None))
+            except ValueError:
+                items.append((None, 'Invalid JSON'))
+        return items
 
     def submit_json(self):
         try:
@@ -140,12 +230,13 @@ class ApiMethod(ApiConnector):
             if not json_data:
                 core.logger.connectors.warning({'status': 'error', 'message': 'No JSON data provided'})
                 return jsonify({'status': 'error', 'message': 'No JSON data provided'}), 400
-            if not (isinstance(json_data, dict) and "url_rms" in json_data and "current_time" in json_data):
+            if not self.validate_submission(json_data):
                 core.logger.connectors.warning("Полученный json не соответствует требуемому формату")
                 return jsonify({'status': 'error', 'message': 'Invalid JSON-data'}), 400
 
             # Добавляем в очередь
-            self.json_queue.put(json_data)
+            if not self.json_queue.put(json_data):
+                return self.queue_full_response()
             core.logger.connectors.info({'status': 'success', 'message': 'Data queued for processing'})
             return jsonify({'status': 'success', 'message': 'Data queued for processing'})
         except Exception as e:
@@ -153,6 +244,58 @@ class ApiMethod(ApiConnector):
             core.logger.connectors.error("Ошибка при обработке JSON через API", exc_info=True)
             return jsonify({'status': 'error', 'message': str(e)}), 500
 
+    def submit_batch(self):
+        try:
+            core.logger.connectors.info("Получен запрос к '/api/submit_batch'")
+
+            try:
+                items = self.parse_batch_body(self.read_request_body())
+            except OverflowError:
+                message = f'Request body is too large, maximum is {self.submit_batch_max_bytes} bytes'
+                core.logger.connectors.warning({'status': 'error', 'message': message})
+                return jsonify({'status': 'error', 'message': message}), 413
+            except (ValueError, zlib.error) as e:
+                # Сюда же попадают ошибки распаковки, декодирования UTF-8 и разбора JSON-массива
+                core.logger.connectors.warning({'status': 'error', 'message': f'Invalid request body: {e}'})
+                return jsonify({'status': 'error', 'message': 'Invalid request body'}), 400
+
+            if not items:
+                core.logger.connectors.warning({'status': 'error', 'message': 'No JSON data provided'})
+                return jsonify({'status': 'error', 'message': 'No JSON data provided'}), 400
+            if len(items) > self.submit_batch_max_items:
+                message = f'Too many items, maximum is {self.submit_batch_max_items} per request'
+                core.logger.connectors.warning({'status': 'error', 'message': message})
+                return jsonify({'status': 'error', 'message': message}), 413
+
+            # Сначала проверяем все записи, затем ставим в очередь принятые
+            results = []
+            accepted = []
+            for index, (json_data, error) in enumerate(items):
+                if error is None and not self.validate_submission(json_data):
+                    error = 'Invalid JSON-data'
+                if error is None:
+                    accepted.append(json_data)
+                    results.append({'index': index, 'status': 'queued'})
+                else:
+                    results.append({'index': index, 'status': 'error', 'message': error})
+
+            if accepted and not self.json_queue.put_many(accepted):
+                return self.queue_full_response()
+
+            rejected = len(items) - len(accepted)
+            core.logger.connectors.info(
+                f"Пакет через API: поставлено в очередь ({len(accepted)}) записей, отклонено ({rejected})")
+            return jsonify({
+                'status': 'success' if accepted else 'error',
+                'accepted': len(accepted),
+                'rejected': rejected,
+                'results': results
+            }), 200 if accepted else 400
+        except Exception as e:
+            core.logger.connectors.warning({'status': 'error', 'message': str(e)})
+            core.logger.connectors.error("Ошибка при обработке пакета JSON через API", exc_info=True)
+            return jsonify({'status': 'error', 'message': str(e)}), 500
+
     def get_serial_numbers(self):
         try:
             # Получаем JSON из запроса
@@ -190,20 +333,43 @@ class ApiMethod(ApiConnector):
                     {'status': 'error', 'message': 'Request must be a JSON array of serial numbers'})
                 return jsonify({'status': 'error', 'message': 'Request must be a JSON array of serial numbers'}), 400
 
-            # Проверяем, что в запросе пришел список серийных номеров
-            serial_numbers = json_data
+            if len(json_data) > self.max_serial_numbers:
+                message = f'Too many serial numbers, maximum is {self.max_serial_numbers} per request'
+                core.logger.connectors.warning({'status': 'error', 'message': message})
+                return jsonify({'status': 'error', 'message': message}), 413
 
-            # Если список пуст, возвращаем пустой результат
-            if not serial_numbers:
-                core.logger.connectors.warning("Получен пустой список серийных номеров")
-                return jsonify([])
+            # Повторы убираем, а записи отдаём в порядке serialNumber, поэтому страницы ответа
+            # (?offset=&limit= по списку серийных номеров) стабильны между запросами
+            serial_numbers = sorted({str(serial_number) for serial_number in json_data})
 
-            # Получаем данные из БД
-            fiscals_data = dbquerie.get_fiscals_by_serial_numbers(serial_numbers)
+            try:
+                offset = int(request.args.get('offset', 0))
+                limit = int(request.args.get('limit', len(serial_numbers)))
+                if offset < 0 or limit < 1:
+                    raise ValueError
+            except ValueError:
+                message = 'offset and limit must be non-negative integers, limit must be greater than zero'
+                core.logger.connectors.warning({'status': 'error', 'message': message})
+                return jsonify({'status': 'error', 'message': message}), 400
 
-            core.logger.connectors.info(jsonify(fiscals_data))
-            core.logger.connectors.debug(fiscals_data)
-            return jsonify(fiscals_data)
+            page = serial_numbers[offset:offset + limit]
+
+            # Получаем данные из БД
+            try:
+                records = dbquerie.get_fiscals_by_serial_numbers(page, self.requested_fields())
+            except ValueError as e:
+                core.logger.connectors.warning({'status': 'error', 'message': str(e)})
+                return jsonify({'status': 'error', 'message': str(e)}), 400
+
+            core.logger.connectors.info(
+                f"Запрошены данные ({len(page)}) ККТ из списка в ({len(serial_numbers)}) серийных номеров, "
+                f"смещение ({offset})")
+
+            response = self.records_response(records)
+            response.headers['X-Total-Count'] = str(len(serial_numbers))
+            if offset + limit < len(serial_numbers):
+                response.headers['X-Next-Offset'] = str(offset + limit)
+            return response
         except Exception as e:
             core.logger.connectors.warning({'status': 'error', 'message': str(e)})
             core.logger.connectors.error("Ошибка при получении данных о ККТ по серийным номерам через API",
@@ -213,49 +379,135 @@ class ApiMethod(ApiConnector):
     def get_pos_data(self):
         try:
             core.logger.connectors.info("Получен запрос к '/api/get_pos_data'")
-            data, columns = dbquerie.get_only_pos()
-
-            pos_data = []
-
-            for row in data:
-                pos_dict = {}
-                for i, column in enumerate(columns):
-                    # Для полей типа JSON или списков преобразуем в строковый формат
-                    if isinstance(row[i], (dict, list)):
-                        pos_dict[column] = json.dumps(row[i], ensure_ascii=False)
-                    else:
-                        pos_dict[column] = row[i]
-                pos_data.append(pos_dict)
-            return jsonify(pos_data)
+
+            try:
+                records = dbquerie.get_pos_records(self.requested_fields())
+            except ValueError as e:
+                core.logger.connectors.warning({'status': 'error', 'message': str(e)})
+                return jsonify({'status': 'error', 'message': str(e)}), 400
+
+            return self.records_response(records)
         except Exception as e:
             core.logger.connectors.warning({'status': 'error', 'message': str(e)})
             core.logger.connectors.error("Ошибка при получении данных о POS через API",
                                          exc_info=True)
             return jsonify({'status': 'error', 'message': str(e)}), 500
 
+    def get_changes(self):
+        try:
+            core.logger.connectors.info("Получен запрос к '/api/changes'")
+
+            try:
+                limit = int(request.args.get('limit', 500))
+                if limit < 1:
+                    raise ValueError
+            except ValueError:
+                message = 'limit must be a positive integer'
+                core.logger.connectors.warning({'status': 'error', 'message': message})
+                return jsonify({'status': 'error', 'message': message}), 400
+
+            # Курсор из ответа передаётся в ?since= следующего запроса, без курсора лента читается с начала
+            try:
+                result = dbquerie.get_changes(request.args.get('since'), min(limit, self.max_changes))
+            except ValueError as e:
+                core.logger.connectors.warning({'status': 'error', 'message': str(e)})
+                return jsonify({'status': 'error', 'message': str(e)}), 400
+            except core.dbmanagement.ChangesCursorExpired as e:
+                core.logger.connectors.warning({'status': 'error', 'message': str(e)})
+                return jsonify({'status': 'error', 'message': 'Cursor is older than the change retention period, '
+                                'resync by reading the changes without ?since=', 'resync': True}), 410
+
+            core.logger.connectors.info(f"Отдано ({len(result['changes'])}) изменений записей")
+            return jsonify(result)
+        except Exception as e:
+            core.logger.connectors.warning({'status': 'error', 'message': str(e)})
+            core.logger.connectors.error("Ошибка при получении журнала изменений через API", exc_info=True)
+            return jsonify({'status': 'error', 'message': str(e)}), 500
+
+    def get_stats(self):
+        try:
+            core.logger.connectors.info("Получен запрос к '/api/get_stats'")
+            stats = {
+                'db_pool': core.dbpool.db_pool.get_stats(),
+                'ingest': core.ingest.ingest_pipeline.get_stats(),
+                'client_enrichment': core.ingest.ingest_pipeline.sum_worker_reports(
+                    'client_enrichment', core.dbmanagement.client_enrichment.get_stats()),
+                'rms_cache': core.ingest.ingest_pipeline.sum_worker_reports('rms_cache', IikoRms.cache.get_stats()),
+                'suggest_cache': core.dbmanagement.DbQueries.suggest_cache.get_stats()
+            }
+            core.logger.connectors.debug(stats)
+            return jsonify(stats)
+        except Exception as e:
+            core.logger.connectors.warning({'status': 'error', 'message': str(e)})
+            core.logger.connectors.error("Ошибка при получении статистики через API", exc_info=True)
+            return jsonify({'status': 'error', 'message': str(e)}), 500
+
 
 class IikoRms(core.sys_manager.ResourceManagement):
+    # HTTP-сессия и кэш ответов RMS общие для всех экземпляров в процессе
+    cache = core.sys_manager.TtlCache()
+    _session = None
+    _session_pid = None
+    _session_lock = threading.Lock()
+
     def __init__(self):
         super().__init__()
+        try: self.cache_ttl = int(self.config.get("db-update", "rms-cache-ttl-sec", fallback=3600))
+        except: self.cache_ttl = 3600
+
+        try: self.negative_cache_ttl = int(self.config.get("db-update", "rms-negative-cache-ttl-sec", fallback=300))
+        except: self.negative_cache_ttl = 300
+
+    def get_session(self):
+        # Сессия держит keep-alive соединения отдельно для каждого хоста, после fork создаём новую,
+        # чтобы не делить сокеты с родительским процессом
+        with IikoRms._session_lock:
+            if IikoRms._session is None or IikoRms._session_pid != os.getpid():
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=100, pool_maxsize=10)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                IikoRms._session = session
+                IikoRms._session_pid = os.getpid()
+            return IikoRms._session
+
+    def normalize_url(self, url_rms):
+        parts = urllib.parse.urlsplit(url_rms.strip())
+        return urllib.parse.urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path.rstrip('/'), '', ''))
+
+    def get_rms_name(self, url_rms, use_cache=True):
+        cache_key = self.normalize_url(url_rms)
+
+        if use_cache:
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                result, error = cached
+                if error is None:
+                    core.logger.connectors.debug(f"Имя сервера {url_rms} получено из кэша")
+                    return result
+                # Недоступный сервер не опрашиваем повторно, пока не истечёт негативный кэш
+                core.logger.connectors.debug(f"Сервер {url_rms} недавно был недоступен, запрос не выполняется")
+                raise Exception(f"Сервер {url_rms} недоступен: {error}")
 
-    def get_rms_name(self, url_rms):
         try:
             # Формируем URL для запроса
             monitoring_url = f"{url_rms.rstrip('/')}/getServerMonitoringInfo.jsp"
 
             # Делаем запрос
             core.logger.connectors.debug(f"Сделан запрос к {monitoring_url}")
-            response = requests.get(monitoring_url, timeout=20)
+            response = self.get_session().get(monitoring_url, timeout=20)
 
             if response.status_code == 200:
                 core.logger.connectors.debug(f"Код ответа {response.status_code}")
                 json_data = response.json()
                 server_name = json_data.get('serverName', '')
                 version = json_data.get('version', '')
+                self.cache.set(cache_key, ((server_name, version), None), self.cache_ttl)
                 return server_name, version
             else:
                 raise Exception(f"Код ответа {response.status_code}")
-        except Exception:
+        except Exception as e:
+            self.cache.set(cache_key, (None, str(e)), self.negative_cache_ttl)
             core.logger.connectors.error(f"Не удалось сделать запрос к {url_rms}", exc_info=True)
             raise
 
@@ -1,78 +1,49 @@
 import core.sys_manager
 import core.logger
 import core.configs
+import core.dbpool
 import os
 import json
+import re
+import base64
+import hashlib
 import time
+import datetime
 import threading
+import queue
 import uuid
+import urllib.parse
+import concurrent.futures
+import itertools
 import psycopg2
 import psycopg2.extras
 
 
+class ChangesCursorExpired(Exception):
+    # Курсор журнала изменений старше срока хранения отметок об удалении: часть удалений уже очищена,
+    # и клиенту нужно синхронизироваться заново, прочитав журнал без курсора
+    pass
+
+
 class DatabaseContextManager(core.sys_manager.ResourceManagement):
     def __init__(self):
         super().__init__()
-        self.dbname = self.config.get("db-update", "db-name", fallback="getad")
-        self.host = self.config.get("db-update", "host", fallback="localhost")
-        self.port = self.config.get("db-update", "port", fallback="5432")
-        self.user = self.config.get("db-update", "user", fallback="postgres")
-        self.password = self.config.get("db-update", "password", fallback="")
         self.conn = None
         self.cursor = None
 
     def __enter__(self):
         try:
-            # Пытаемся подключиться к базе данных
-            try:
-                self.conn = psycopg2.connect(
-                    dbname=self.dbname,
-                    user=self.user,
-                    password=self.password,
-                    host=self.host,
-                    port=self.port
-                )
-                self.cursor = self.conn.cursor()
-            except psycopg2.OperationalError as e:
-                # Проверяем, что ошибка связана с отсутствием базы данных
-                if "database" in str(e) and "does not exist" in str(e):
-                    temp_conn = psycopg2.connect(
-                        dbname='postgres',
-                        user=self.user,
-                        password=self.password,
-                        host=self.host,
-                        port=self.port
-                    )
-                    temp_conn.autocommit = True  # Необходимо для создания БД
-                    temp_cursor = temp_conn.cursor()
-
-                    # Создаём новую базу данных
-                    temp_cursor.execute(f'CREATE DATABASE "{self.dbname}"')
-
-                    # Закрываем временное соединение
-                    temp_cursor.close()
-                    temp_conn.close()
-
-                    core.logger.db_service.info(f"Создана новая база данных: {self.dbname}")
-
-                    # Теперь подключаемся к только что созданной базе
-                    self.conn = psycopg2.connect(
-                        dbname=self.dbname,
-                        user=self.user,
-                        password=self.password,
-                        host=self.host,
-                        port=self.port
-                    )
-                    self.cursor = self.conn.cursor()
-                else:
-                    # Если ошибка не связана с отсутствием БД, пробрасываем её дальше
-                    raise
-
+            # Берём соединение из общего пула процесса вместо нового подключения
+            self.conn = core.dbpool.db_pool.getconn()
+            self.cursor = self.conn.cursor()
             return self
         except Exception:
             core.logger.db_service.error(
                 "Не удалось подключиться к базе данных", exc_info=True)
-            time.sleep(5)
+            if self.conn:
+                core.dbpool.db_pool.putconn(self.conn)
+                self.conn = None
+            core.dbpool.cooperative_sleep(5)
             raise
 
     def __exit__(self, exc_type, exc_value, traceback):
@@ -87,79 +58,286 @@ class DatabaseContextManager(core.sys_manager.ResourceManagement):
                 try: self.conn.commit()
                 except: pass
 
-        # Закрываем соединение в любом случае
-        if self.conn:
-            try: self.conn.close()
+        if self.cursor:
+            try: self.cursor.close()
             except: pass
+            self.cursor = None
+
+        # Возвращаем соединение в пул в любом случае
+        if self.conn:
+            core.dbpool.db_pool.putconn(self.conn)
+            self.conn = None
+
+
+class TableColumns:
+    def __init__(self, table_name, names):
+        self.table_name = table_name
+        self.all_names = list(names)
+        self.names_lower = {name.lower() for name in self.all_names}
+
+        # Служебные столбцы (с префиксом "_") заполняет сервер, в веб-интерфейс и API они не отдаются
+        self.visible_indexes = [index for index, name in enumerate(self.all_names) if not name.startswith('_')]
+        self.names = [self.all_names[index] for index in self.visible_indexes]
+        self.positions = {name: index for index, name in enumerate(self.names)}
+
+        # Индексы столбцов, которые нужны при обработке каждой строки
+        self.licenses_index = self.positions.get('licenses', -1)
+        self.current_time_index = self.positions.get('current_time', -1)
+        self.v_time_index = self.positions.get('v_time', -1)
+
+    def project(self, rows):
+        # Убираем из строк результата SELECT * служебные столбцы
+        if len(self.visible_indexes) == len(self.all_names):
+            return rows
+        return [tuple(row[index] for index in self.visible_indexes) for row in rows]
+
+
+class ColumnCatalog:
+    # Кэш столбцов динамических таблиц, общий для всех запросов процесса
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tables = {}
+        self._ignored_keys = set()  # Уже отмеченные в логе ключи с префиксом "_"
+
+    def get(self, db, table_name):
+        columns = self._tables.get(table_name)
+        if columns is not None:
+            return columns
+
+        db.cursor.execute('''
+            SELECT column_name 
+            FROM information_schema.columns 
+            WHERE table_name = %s AND table_schema = current_schema()
+            ORDER BY ordinal_position
+        ''', (table_name,))
+        columns = TableColumns(table_name, [row[0] for row in db.cursor.fetchall()])
+
+        with self._lock:
+            self._tables[table_name] = columns
+        return columns
+
+    def resolve(self, table_name, description):
+        # Сверяем кэш со столбцами фактического результата SELECT *: если столбец добавил
+        # другой процесс, пересобираем запись по описанию курсора без обращения к каталогу БД
+        names = [column[0] for column in description]
+        columns = self._tables.get(table_name)
+        if columns is None or columns.all_names != names:
+            columns = TableColumns(table_name, names)
+            with self._lock:
+                self._tables[table_name] = columns
+        return columns
+
+    def invalidate(self, table_name):
+        with self._lock:
+            self._tables.pop(table_name, None)
+
+    def ensure_columns(self, db, table_name, keys):
+        # Добавляем столбцы для новых ключей JSON, кэш сбрасываем только если схема изменилась
+        columns = self.get(db, table_name)
+
+        missing = {}
+        ignored = []
+        for key in keys:
+            # Ключи с префиксом "_" зарезервированы под служебные столбцы
+            if key.startswith('_'):
+                if (table_name, key) not in self._ignored_keys:
+                    ignored.append(key)
+                continue
+            if key.lower() not in columns.names_lower and key.lower() not in missing:
+                missing[key.lower()] = key
+
+        if ignored:
+            # Каждый такой ключ отмечаем в логе один раз за время работы процесса
+            with self._lock:
+                self._ignored_keys.update((table_name, key) for key in ignored)
+            core.logger.db_service.warning(
+                f"Ключи JSON с префиксом '_' зарезервированы под служебные столбцы и не сохраняются "
+                f"в таблицу '{table_name}': {sorted(ignored)}")
+
+        if not missing:
+            return
+
+        for key in missing.values():
+            # IF NOT EXISTS: столбец мог добавить другой процесс, пока наш кэш был устаревшим
+            db.cursor.execute(f'''ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS "{key}" TEXT''')
+        core.logger.db_service.info(f"В таблицу '{table_name}' добавлены столбцы: {list(missing.values())}")
+        self.invalidate(table_name)
+
+
+column_catalog = ColumnCatalog()
 
 
 class DbQueries(DatabaseContextManager):
+    # Сколько серийных номеров передаётся в одном запросе при выборке по списку
+    serial_chunk_size = 1000
+
+    # Кэш подсказок строки поиска, общий для всех экземпляров в процессе
+    suggest_cache = core.sys_manager.TtlCache(max_size=1000)
+
+    # Поля подсказок: (поле, префикс запроса поиска, таблица, столбец значения, столбец для запроса поиска)
+    suggest_fields = [
+        ('serialNumber', 'serial', 'pos_fiscals', 'serialNumber', 'serialNumber'),
+        ('INN', 'inn', 'pos_fiscals', 'INN', 'INN'),
+        ('RNM', 'rnm', 'pos_fiscals', 'RNM', 'RNM'),
+        ('fn_serial', 'fn', 'pos_fiscals', 'fn_serial', 'fn_serial'),
+        ('serverName', 'url', 'clients', 'serverName', 'url_rms'),
+    ]
+
     def __init__(self):
         super().__init__()
         try: self.dont_valid_fn = int(self.config.get("db-update", "day_filter_expire", fallback=14))
         except: self.dont_valid_fn = 14
 
+        try: self.suggest_limit = int(self.config.get("webserver", "suggest-limit", fallback=10))
+        except: self.suggest_limit = 10
+
+        try: self.suggest_cache_ttl = int(self.config.get("webserver", "suggest-cache-ttl-sec", fallback=30))
+        except: self.suggest_cache_ttl = 30
+
+        self.suggest_limit = min(max(self.suggest_limit, 1), 50)
+
+        try: self.stream_fetch_size = int(self.config.get("webserver", "stream-fetch-size", fallback=500))
+        except: self.stream_fetch_size = 500
+
+        self.stream_fetch_size = max(self.stream_fetch_size, 1)
+
+    def to_db_value(self, value):
+        # Все динамические столбцы текстовые, поэтому приводим значения к строке заранее:
+        # в многострочном VALUES значения разных типов в одном столбце не сводятся к общему типу
+        if value is None or isinstance(value, str):
+            return value
+        if isinstance(value, (dict, list)):
+            return json.dumps(value, ensure_ascii=False)
+        if isinstance(value, bool):
+            return 'true' if value else 'false'
+        return str(value)
+
+    def content_hash(self, json_data):
+        # Хэш нормализованного JSON: одинаковые отчёты дают одинаковый хэш независимо от порядка ключей
+        normalized = json.dumps(json_data, ensure_ascii=False, sort_keys=True, separators=(',', ':'), default=str)
+        return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+    def upsert_rows(self, db, table_name, key_column, data, update_where=None):
+        # Группируем записи по набору ключей, чтобы каждую группу записать одним многострочным INSERT.
+        # update_where(columns) может вернуть условие, при котором существующая строка перезаписывается.
+        # Возвращает {ключ: True для вставленной строки, False для обновлённой} и множество ключей
+        # записей, которые не изменились с прошлой записи и поэтому не перезаписывались
+        groups = {}
+        hashes = {}
+        for key_value, json_data in data.items():
+            columns = tuple(sorted(key for key in json_data.keys()
+                                   if key.lower() != key_column.lower() and not key.startswith('_')))
+            hashes[key_value] = self.content_hash(json_data)
+            groups.setdefault(columns, []).append(
+                (key_value, hashes[key_value], *[self.to_db_value(json_data.get(key, '')) for key in columns]))
+
+        written = {}
+        for columns, rows in groups.items():
+            columns_str = ''.join([f', "{col}"' for col in columns])
+            set_str = ''.join([f', "{col}" = EXCLUDED."{col}"' for col in columns])
+
+            # Запись с тем же хэшем содержимого не перезаписываем, чтобы не плодить мёртвые версии строк
+            condition = f'{table_name}."_content_hash" IS DISTINCT FROM EXCLUDED."_content_hash"'
+            extra_condition = update_where(columns) if update_where else None
+            if extra_condition:
+                condition += f' AND {extra_condition}'
+
+            # xmax = 0 только у только что вставленной версии строки, у обновлённой в нём id нашей транзакции.
+            # Строки, которые условие не дало обновить, в RETURNING не попадают
+            result = psycopg2.extras.execute_values(
+                db.cursor,
+                f'''INSERT INTO {table_name} ("{key_column}", "_content_hash"{columns_str})
+                    VALUES %s
+                    ON CONFLICT ("{key_column}")
+                    DO UPDATE SET "_content_hash" = EXCLUDED."_content_hash"{set_str}
+                    WHERE {condition}
+                    RETURNING "{key_column}", (xmax = 0)''',
+                rows, page_size=len(rows), fetch=True)
+            written.update(dict(result))
+
+        unchanged = set()
+        not_written = [key_value for key_value in data if key_value not in written]
+        if not_written:
+            # Отличаем неизменившиеся записи от отклонённых условием update_where
+            db.cursor.execute(f'''
+                SELECT "{key_column}", "_content_hash" FROM {table_name}
+                WHERE "{key_column}" = ANY(%s)
+            ''', (not_written,))
+            for key_value, stored_hash in db.cursor.fetchall():
+                if stored_hash == hashes[key_value]:
+                    unchanged.add(key_value)
+
+        return written, unchanged
+
+    def upsert_not_fiscals(self, db, data):
+        if not data:
+            return {"written": 0, "unchanged": 0, "stale": 0}
+
+        # Проверка и добавление новых столбцов по объединению ключей всех записей пакета
+        json_keys = set()
+        for json_data in data.values():
+            json_keys.update(json_data.keys())
+        column_catalog.ensure_columns(db, 'pos_not_fiscals', json_keys)
+
+        written, unchanged = self.upsert_rows(db, 'pos_not_fiscals', 'filename', data)
+        return {"written": len(written), "unchanged": len(unchanged), "stale": 0}
+
+    def fiscals_update_where(self, columns):
+        if 'v_time' not in columns:
+            return None
+
+        # Существующую запись перезаписываем, только если пришёл непустой v_time не старее сохранённого.
+        # COLLATE "C" сравнивает строки посимвольно, так же как раньше сравнивались строки в Python
+        return '''EXCLUDED."v_time" IS NOT NULL AND EXCLUDED."v_time" <> ''
+                  AND (pos_fiscals."v_time" IS NULL OR pos_fiscals."v_time" = ''
+                       OR pos_fiscals."v_time" COLLATE "C" <= EXCLUDED."v_time" COLLATE "C")'''
+
+    def upsert_fiscals(self, db, data):
+        # Возвращает записи, которых ещё не было в pos_fiscals, и счётчики записанных,
+        # неизменившихся и пропущенных из-за более ранней даты записей
+        if not data:
+            return [], {"written": 0, "unchanged": 0, "stale": 0}
+
+        # Проверка и добавление новых столбцов по объединению ключей всех записей пакета
+        json_keys = set()
+        for json_data in data.values():
+            json_keys.update(json_data.keys())
+        column_catalog.ensure_columns(db, 'pos_fiscals', json_keys)
+
+        # Проверка v_time выполняется в самом UPSERT, под блокировкой строки, поэтому
+        # одновременные записи одного устройства не перезатирают более свежие данные
+        written, unchanged = self.upsert_rows(db, 'pos_fiscals', 'serialNumber', data, self.fiscals_update_where)
+
+        new_records = []
+        stale = 0
+        for serial_number, json_data in data.items():
+            if serial_number in unchanged:
+                continue
+            if serial_number not in written:
+                stale += 1
+                core.logger.db_service.warning(
+                    f"Добавляемый файл '{serial_number}' имеет более раннюю дату, обновление записи пропущено")
+            # Если запись действительно вставлена и есть url_rms - добавляем в таблицу clients
+            elif written[serial_number] and json_data.get('url_rms'):
+                new_records.append(json_data)
+
+        return new_records, {"written": len(written), "unchanged": len(unchanged), "stale": stale}
+
+    def add_clients_for_records(self, records):
+        # Имена серверов новых клиентов запрашиваются в фоне, сохранение данных их не ждёт
+        for json_data in records:
+            client_enrichment.submit(
+                json_data['url_rms'], json_data.get('INN', ''), json_data.get('organizationName', ''))
+
     def save_not_fiscal(self, json_data, filename):
         try:
             with DatabaseContextManager() as db:
-                # Получение списка уникальных ключей JSON для создания столбцов
-                json_keys = json_data.keys()
-
-                # Создание таблицы для нефискальных JSON-файлов, если её ещё нет
-                db.cursor.execute('''CREATE TABLE IF NOT EXISTS pos_not_fiscals (
-                                    "filename" TEXT PRIMARY KEY
-                                );''')
-
-                # Получение существующих столбцов из таблицы
-                db.cursor.execute('''
-                    SELECT column_name 
-                    FROM information_schema.columns 
-                    WHERE table_name = 'pos_not_fiscals'
-                ''')
-                existing_columns = {row[0].lower() for row in db.cursor.fetchall()}
-
-                # Проверка и добавление новых столбцов
-                for key in json_keys:
-                    if key.lower() not in existing_columns:
-                        db.cursor.execute(f'''ALTER TABLE pos_not_fiscals ADD COLUMN "{key}" TEXT''')
-                        existing_columns.add(key.lower())
-
-                # Формирование значений для вставки
-                values = []
-                columns = []
-                original_columns = []
-
-                for key in json_keys:
-                    if key.lower() != 'filename':  # Пропускаем filename, так как он обрабатывается отдельно
-                        columns.append(f'"{key}"')
-                        original_columns.append(key)
-                        value = json_data.get(key, '')
-                        if isinstance(value, dict):
-                            value = json.dumps(value, ensure_ascii=False)
-                        values.append(value)
-
-                # Формирование SQL запроса
-                placeholders = ', '.join(['%s'] * len(values))  # В PostgreSQL используем %s вместо ?
-                columns_str = ', '.join(columns)
-
-                # Вставка данных (используем ON CONFLICT вместо INSERT OR REPLACE)
-                if columns:  # Проверяем, что у нас есть столбцы для вставки
-                    db.cursor.execute(
-                        f'''INSERT INTO pos_not_fiscals ("filename", {columns_str})
-                            VALUES (%s, {placeholders})
-                            ON CONFLICT ("filename") 
-                            DO UPDATE SET {', '.join([f'"{col}" = EXCLUDED."{col}"' for col in original_columns])}''',
-                        (filename, *values)
-                    )
-                else:
-                    # Если нет дополнительных столбцов, просто вставляем filename
-                    db.cursor.execute(
-                        f'''INSERT INTO pos_not_fiscals ("filename")
-                            VALUES (%s)
-                            ON CONFLICT ("filename") DO NOTHING''',
-                        (filename,)
-                    )
+                counters = self.upsert_not_fiscals(db, {filename: json_data})
+            if counters["unchanged"]:
+                core.logger.db_service.debug(f"Запись '{filename}' не изменилась, обновление не требуется")
+            else:
                 core.logger.db_service.debug(f"Запись '{filename}' успешно добавлена в базу")
+            return counters
         except Exception:
             core.logger.db_service.error(
                 f"Не удалось сохранить JSON-файл {filename} в таблицу [pos_not_fiscals]", exc_info=True)
@@ -167,106 +345,127 @@ class DbQueries(DatabaseContextManager):
     def save_fiscals(self, data):
         try:
             with DatabaseContextManager() as db:
-                # Создание таблицы, если она не существует
-                db.cursor.execute('''CREATE TABLE IF NOT EXISTS pos_fiscals (
-                                    "serialNumber" TEXT PRIMARY KEY
-                                )''')
-
-                # Получение существующих столбцов из таблицы
-                db.cursor.execute('''
-                    SELECT column_name 
-                    FROM information_schema.columns 
-                    WHERE table_name = 'pos_fiscals'
-                ''')
-                existing_columns = {row[0].lower() for row in db.cursor.fetchall()}  # Преобразуем в нижний регистр
+                new_records, counters = self.upsert_fiscals(db, data)
+            core.logger.db_service.debug(
+                f"Записи {list(data.keys())} обработаны: записано ({counters['written']}), "
+                f"без изменений ({counters['unchanged']}), пропущено ({counters['stale']})")
 
-                try:
-                    # Вставка данных
-                    for filename, json_data in data.items():
-                        # Проверяем существование записи в pos_fiscals
-                        db.cursor.execute('''
-                            SELECT "serialNumber", "v_time" FROM pos_fiscals
-                            WHERE "serialNumber" = %s
-                        ''', (filename,))
-                        existing_record = db.cursor.fetchone()
-
-                        # Проверка v_time, если запись уже существует
-                        if existing_record and "v_time" in json_data:
-                            existing_v_time = existing_record[1]
-                            new_v_time = json_data.get("v_time")
-
-                            # Пропускаем обновление, если новый v_time отсутствует или старее существующего
-                            if not new_v_time or (existing_v_time and str(existing_v_time) > str(new_v_time)):
-                                core.logger.db_service.warning(
-                                    f"Добавляемый файл имеет более раннюю дату, обновление записи пропущено")
-                                return
-
-                        # Проверка и добавление новых столбцов
-                        for key, value in json_data.items():
-                            if key.lower() not in existing_columns:
-                                db.cursor.execute(f'''ALTER TABLE pos_fiscals ADD COLUMN "{key}" TEXT''')
-                                existing_columns.add(key.lower())
-
-                        # Формирование значений для вставки
-                        values = []
-                        columns = []
-                        original_columns = []  # Сохраняем оригинальные названия столбцов
-
-                        for key, value in json_data.items():
-                            if key.lower() != 'serialnumber':  # Пропускаем serialNumber, обрабатываем отдельно
-                                columns.append(f'"{key}"')  # Заключаем имя столбца в кавычки
-                                original_columns.append(key)  # Сохраняем оригинальное имя для получения значений
-                                value = json_data.get(key, '')
-                                if isinstance(value, dict):
-                                    value = json.dumps(value, ensure_ascii=False)
-                                values.append(value)
-
-                        # Формирование SQL запроса
-                        placeholders = ', '.join(['%s'] * len(values))
-                        columns_str = ', '.join(columns)
-
-                        # Используем оператор INSERT с ON CONFLICT для обновления при совпадении первичного ключа
-                        if columns:  # Проверяем, что у нас есть столбцы для вставки
-                            db.cursor.execute(
-                                f'''INSERT INTO pos_fiscals ("serialNumber", {columns_str})
-                                   VALUES (%s, {placeholders})
-                                   ON CONFLICT ("serialNumber") 
-                                   DO UPDATE SET {', '.join([f'"{col}" = EXCLUDED."{col}"' for col in original_columns])}''',
-                                (filename, *values))
-                        else:
-                            # Если нет дополнительных столбцов, просто вставляем serialNumber
-                            db.cursor.execute(
-                                f'''INSERT INTO pos_fiscals ("serialNumber")
-                                   VALUES (%s)
-                                   ON CONFLICT ("serialNumber") DO NOTHING''',
-                                (filename,))
-
-                        # Если запись новая и есть url_rms - добавляем в таблицу clients
-                        if not existing_record and 'url_rms' in json_data and json_data['url_rms']:
-                            url_rms = json_data['url_rms']
-                            inn = json_data.get('INN', '')
-                            org_name = json_data.get('organizationName', '')
-
-                            self.add_new_clients(url_rms, inn, org_name)
-
-                    core.logger.db_service.debug(f"Запись '{filename}' успешно добавлена в базу")
-                except Exception:
-                    core.logger.db_service.error(f"Файл уже был удалён", exc_info=True)
-                    pass
+            self.add_clients_for_records(new_records)
+            return counters
         except Exception:
             core.logger.db_service.error(
                 f"Попытка сохранить данные '{data}' в базу данных завершилась неудачей", exc_info=True)
 
+    def write_batch(self, db, fiscals, not_fiscals):
+        # Записывает пакет фискальных и нефискальных JSON в транзакции db, возвращает новые записи
+        # с url_rms и счётчики записанных, неизменившихся и пропущенных записей
+        db.cursor.execute('SAVEPOINT getad_batch')
+        try:
+            new_records, counters = self.upsert_fiscals(db, fiscals)
+            not_fiscal_counters = self.upsert_not_fiscals(db, not_fiscals)
+            db.cursor.execute('RELEASE SAVEPOINT getad_batch')
+            for name in not_fiscal_counters:
+                counters[name] += not_fiscal_counters[name]
+            counters["fallback"] = False
+            core.logger.db_service.debug(
+                f"Пакет из ({len(fiscals) + len(not_fiscals)}) записей обработан: записано ({counters['written']}), "
+                f"без изменений ({counters['unchanged']}), пропущено ({counters['stale']})")
+            return new_records, counters
+        except Exception:
+            core.logger.db_service.error(
+                f"Не удалось сохранить пакет из ({len(fiscals) + len(not_fiscals)}) записей в базу данных",
+                exc_info=True)
+            self.rollback_to_savepoint(db, 'getad_batch')
+
+        # Пакет не записался целиком (например, из-за одной некорректной записи), поэтому сохраняем
+        # записи по одной в той же транзакции, каждую под своей точкой сохранения, чтобы не потерять остальные
+        core.logger.db_service.warning("Записи пакета будут сохранены по одной")
+        new_records = []
+        counters = {"written": 0, "unchanged": 0, "stale": 0, "fallback": True}
+        records = [({serial_number: json_data}, {}) for serial_number, json_data in fiscals.items()]
+        records += [({}, {filename: json_data}) for filename, json_data in not_fiscals.items()]
+        for record_fiscals, record_not_fiscals in records:
+            db.cursor.execute('SAVEPOINT getad_record')
+            try:
+                record_new, record_counters = self.upsert_fiscals(db, record_fiscals)
+                not_fiscal_counters = self.upsert_not_fiscals(db, record_not_fiscals)
+                db.cursor.execute('RELEASE SAVEPOINT getad_record')
+            except Exception:
+                core.logger.db_service.error(
+                    f"Попытка сохранить данные '{record_fiscals or record_not_fiscals}' в базу данных "
+                    f"завершилась неудачей", exc_info=True)
+                self.rollback_to_savepoint(db, 'getad_record')
+                continue
+            new_records += record_new
+            for name in ("written", "unchanged", "stale"):
+                counters[name] += record_counters[name] + not_fiscal_counters[name]
+        return new_records, counters
+
+    def rollback_to_savepoint(self, db, savepoint):
+        db.cursor.execute(f'ROLLBACK TO SAVEPOINT {savepoint}')
+        # Столбцы, добавленные до отката, исчезли вместе с ним, поэтому кэш столбцов перечитываем
+        column_catalog.invalidate('pos_fiscals')
+        column_catalog.invalidate('pos_not_fiscals')
+
+    def save_batch(self, fiscals, not_fiscals):
+        # Сохраняет пакет фискальных и нефискальных JSON одной транзакцией,
+        # возвращает счётчики записанных, неизменившихся и пропущенных записей
+        with DatabaseContextManager() as db:
+            new_records, counters = self.write_batch(db, fiscals, not_fiscals)
+        self.add_clients_for_records(new_records)
+        return counters
+
+    def enqueue_ingest_items(self, items):
+        # items - [(ключ устройства, v_time, JSON-текст)] без повторов ключа. Если отчёт устройства уже ждёт
+        # в очереди, он заменяется новым, только если новый не старее по v_time
+        with DatabaseContextManager() as db:
+            psycopg2.extras.execute_values(
+                db.cursor,
+                '''INSERT INTO ingest_queue ("item_key", "v_time", "payload")
+                   VALUES %s
+                   ON CONFLICT ("item_key")
+                   DO UPDATE SET "v_time" = EXCLUDED."v_time", "payload" = EXCLUDED."payload"
+                   WHERE COALESCE(EXCLUDED."v_time", '') >= COALESCE(ingest_queue."v_time", '')''',
+                items, page_size=len(items))
+
+    def process_ingest_batch(self, limit, prepare):
+        # Забирает до limit записей очереди, не занятых другими обработчиками (в том числе на других
+        # экземплярах сервера), записывает их и удаляет из очереди одной короткой транзакцией на одном
+        # соединении. prepare раскладывает записи на фискальные и нефискальные. Возвращает None, если
+        # очередь пуста, иначе (записи очереди, фискальные, нефискальные, счётчики) - всё, что нужно
+        # сделать после записи (резервная копия на FTP, статистика), выполняется уже после фиксации
+        with DatabaseContextManager() as db:
+            db.cursor.execute('''
+                SELECT "id", "payload" FROM ingest_queue
+                ORDER BY "id"
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            ''', (limit,))
+            rows = db.cursor.fetchall()
+            if not rows:
+                return None
+
+            batch = [json.loads(payload) for _, payload in rows]
+            fiscals, not_fiscals = prepare(batch)
+            new_records, counters = self.write_batch(db, fiscals, not_fiscals)
+            db.cursor.execute('DELETE FROM ingest_queue WHERE "id" = ANY(%s)', ([row[0] for row in rows],))
+
+        self.add_clients_for_records(new_records)
+        return batch, fiscals, not_fiscals, counters
+
+    def get_ingest_queue_state(self):
+        # Количество записей в очереди и возраст самой старой из них в секундах
+        with DatabaseContextManager() as db:
+            db.cursor.execute('''
+                SELECT count(*), EXTRACT(EPOCH FROM CURRENT_TIMESTAMP - min("enqueued_at"))
+                FROM ingest_queue
+            ''')
+            depth, oldest_age = db.cursor.fetchone()
+        return depth, round(float(oldest_age), 1) if oldest_age is not None else 0
+
     def clean_fn_sale_task(self):
         try:
             with DatabaseContextManager() as db:
-                db.cursor.execute('''
-                    CREATE TABLE IF NOT EXISTS fn_sale_task (
-                        "serialNumber" TEXT PRIMARY KEY,
-                        "fn_serial" TEXT
-                    )
-                ''')
-
                 # Получаем все записи из fn_sale_task
                 db.cursor.execute('SELECT "serialNumber", "fn_serial" FROM fn_sale_task')
                 task_records = db.cursor.fetchall()
@@ -297,6 +496,30 @@ class DbQueries(DatabaseContextManager):
         except Exception:
             core.logger.db_service.error("Не удалось выполнить очистку fn_sale_task", exc_info=True)
 
+    def clean_change_tombstones(self, retention_days):
+        # Удаляет отметки об удалении старше retention_days дней и запоминает наибольший номер транзакции
+        # среди удалённых, чтобы более ранние курсоры журнала изменений отклонялись, а не пропускали удаления
+        try:
+            with DatabaseContextManager() as db:
+                db.cursor.execute('''
+                    WITH purged AS (
+                        DELETE FROM change_tombstones
+                        WHERE "deleted_at" < CURRENT_TIMESTAMP - make_interval(days => %s)
+                        RETURNING "change_txid"
+                    )
+                    SELECT count(*), max("change_txid") FROM purged
+                ''', (retention_days,))
+                purged, purged_txid = db.cursor.fetchone()
+                if purged:
+                    db.cursor.execute('''
+                        UPDATE change_feed_state SET "purged_txid" = GREATEST("purged_txid", %s::xid8)
+                        WHERE "id" = 1
+                    ''', (purged_txid,))
+                    core.logger.db_service.info(
+                        f"Удалено ({purged}) отметок об удалении старше ({retention_days}) дней")
+        except Exception:
+            core.logger.db_service.error("Не удалось очистить отметки об удалении", exc_info=True)
+
     def clean_obsolete_clients(self):
         core.logger.db_service.info("Будет произведена очистка базы клиентов")
 
@@ -353,163 +576,376 @@ class DbQueries(DatabaseContextManager):
             core.logger.db_service.error(
                 "Не удалось выполнить очистку устаревших записей из таблицы 'clients'", exc_info=True)
 
-    def get_data_pos_fiscals(self):
+    def staleness_time_sql(self):
+        # Время, по которому определяется устаревание записи: v_time, а если его нет - current_time
+        return '''(CASE WHEN pos_fiscals."v_time" IS NULL OR pos_fiscals."v_time" IN ('', 'None')
+                        THEN pos_fiscals."current_time" ELSE pos_fiscals."v_time" END)'''
+
+    def staleness_timestamp_sql(self):
+        # То же время, но из типизированных столбцов, которые PostgreSQL вычисляет при записи
+        return '''(CASE WHEN pos_fiscals."v_time" IS NULL OR pos_fiscals."v_time" IN ('', 'None')
+                        THEN pos_fiscals."_current_time_ts" ELSE pos_fiscals."_v_time_ts" END)'''
+
+    def staleness_cutoff(self):
+        # Момент, один на весь запрос: записи со временем раньше него считаются устаревшими (day_filter_expire)
+        return datetime.datetime.now() - datetime.timedelta(days=self.dont_valid_fn)
+
+    def expired_flag_sql(self):
+        # Признак устаревания записи вычисляется в самом запросе, параметр - staleness_cutoff().
+        # Запись без даты не считается устаревшей, а с датой, которую не удалось разобрать, - считается
+        return f'''(CASE WHEN COALESCE({self.staleness_time_sql()}, '') = '' THEN false
+                         ELSE COALESCE({self.staleness_timestamp_sql()} < %s, true)
+                    END)'''
+
+    def split_expired_flag(self, columns, rows):
+        # Последний столбец выборки - признак устаревания, переносим его в конец видимой части строки
+        visible_rows = columns.project([row[:-1] for row in rows])
+        return [list(values) + [row[-1]] for values, row in zip(visible_rows, rows)]
+
+    def encode_page_cursor(self, values):
+        # Курсор страницы непрозрачен для клиента: это JSON в base64
+        return base64.urlsafe_b64encode(json.dumps(values, ensure_ascii=False).encode('utf-8')).decode('ascii')
+
+    def decode_page_cursor(self, cursor, types=None):
+        # types - ожидаемые типы элементов курсора: курсор другой формы отклоняется как некорректный
         try:
-            with DatabaseContextManager() as db:
-                db.cursor.execute('SELECT * FROM pos_fiscals')
-                data = db.cursor.fetchall()
-
-                # Получаем названия столбцов из информационной схемы PostgreSQL
-                db.cursor.execute('''
-                    SELECT column_name 
-                    FROM information_schema.columns 
-                    WHERE table_name = 'pos_fiscals'
-                    ORDER BY ordinal_position
-                ''')
-                columns = [column[0] for column in db.cursor.fetchall()]
-
-                # Создаём новый список для данных с дополнительной информацией об устаревании
-                modified_data = []
-                for row in data:
-                    row_dict = dict(zip(columns, row))  # Преобразуем строку в словарь для удобства доступа
-                    modified_row = list(row)
-
-                    # Определяем индексы важных столбцов
-                    licenses_data_index = columns.index('licenses') if 'licenses' in columns else -1
-                    current_time_index = columns.index('current_time') if 'current_time' in columns else -1
-                    v_time_index = columns.index('v_time') if 'v_time' in columns else -1
-
-                    # Обработка licenses
-                    if licenses_data_index >= 0 and row[licenses_data_index]:
-                        modified_row[licenses_data_index] = row[licenses_data_index]
+            values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+        except Exception:
+            raise ValueError("Некорректный курсор страницы")
 
-                    # Проверка устаревания записи
-                    time_to_check = None
-                    if v_time_index >= 0 and current_time_index >= 0:
-                        time_to_check = row[v_time_index] if row[v_time_index] not in (None, '', 'None') else row[
-                            current_time_index]
+        if types is not None:
+            # bool - подкласс int, поэтому тип сравниваем точно
+            if not isinstance(values, list) or len(values) != len(types) or \
+                    any(type(value) is not value_type for value, value_type in zip(values, types)):
+                raise ValueError("Некорректный курсор страницы")
+        return values
 
-                    is_expired = False
-                    if time_to_check:
-                        is_expired = not self.if_show_fn_to_date(time_to_check, self.dont_valid_fn)
+    def escape_like(self, text):
+        return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
 
-                    # Добавляем признак устаревания в строку
-                    modified_row.append(is_expired)
+    def get_fiscals_columns(self):
+        try:
+            with DatabaseContextManager() as db:
+                # Пустая выборка сверяет кэш столбцов с фактической таблицей
+                db.cursor.execute('SELECT * FROM pos_fiscals LIMIT 0')
+                return column_catalog.resolve('pos_fiscals', db.cursor.description).names
+        except Exception:
+            core.logger.db_service.error("Не удалось получить список столбцов 'pos_fiscals'", exc_info=True)
+            return []
 
-                    modified_data.append(modified_row)
+    def fiscals_filter_conditions(self, columns, filters):
+        # Условия фильтров таблицы ФР. Значения сравниваются так же, как они отображаются в таблице:
+        # отсутствующее значение как 'None'
+        conditions = []
+        params = []
+        for column_filter in filters:
+            column = column_filter.get('column')
+            text = str(column_filter.get('text') or '')
+            if column not in columns.positions or not text:
+                continue
+            operator = 'NOT ILIKE' if column_filter.get('type') == 'exclude' else 'ILIKE'
+            conditions.append(f'''COALESCE("{column}"::TEXT, 'None') {operator} %s''')
+            params.append(f'%{self.escape_like(text)}%')
+        return conditions, params
+
+    def get_fiscals_page(self, sort_column, descending, filters, cursor=None, limit=200):
+        # Страница таблицы pos_fiscals с сортировкой и фильтрами на стороне БД и keyset-пагинацией:
+        # следующая страница начинается сразу после последней строки предыдущей, без OFFSET
+        with DatabaseContextManager() as db:
+            columns = column_catalog.get(db, 'pos_fiscals')
+            if sort_column not in columns.positions:
+                sort_column = 'serialNumber'
 
-            return modified_data, columns
-        except Exception:
-            core.logger.db_service.error("При чтении таблицы 'pos_fiscals' произошло исключение", exc_info=True)
-            return [], []
+            conditions, params = self.fiscals_filter_conditions(columns, filters)
 
-    def get_only_pos(self):
+            total = None
+            if cursor is None:
+                db.cursor.execute(
+                    f'SELECT count(*) FROM pos_fiscals {"WHERE " + " AND ".join(conditions) if conditions else ""}',
+                    params)
+                total = db.cursor.fetchone()[0]
+
+            sort_key = f'''lower(COALESCE("{sort_column}"::TEXT, 'None'))'''
+            direction = 'DESC' if descending else 'ASC'
+
+            if cursor is not None:
+                cursor_sort_column, cursor_descending, last_key, last_serial = self.decode_page_cursor(
+                    cursor, (str, bool, str, str))
+                if cursor_sort_column != sort_column or cursor_descending != descending:
+                    raise ValueError("Курсор страницы не соответствует сортировке")
+                conditions.append(f'({sort_key}, "serialNumber") {"<" if descending else ">"} (%s, %s)')
+                params += [last_key, last_serial]
+
+            # Ключ сортировки выбираем последним столбцом, чтобы построить курсор следующей страницы
+            db.cursor.execute(f'''
+                SELECT *, {self.expired_flag_sql()}, {sort_key} FROM pos_fiscals
+                {"WHERE " + " AND ".join(conditions) if conditions else ""}
+                ORDER BY {sort_key} {direction}, "serialNumber" {direction}
+                LIMIT %s
+            ''', [self.staleness_cutoff()] + params + [limit + 1])
+            columns = column_catalog.resolve('pos_fiscals', db.cursor.description[:-2])
+            rows = db.cursor.fetchall()
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            last_row = rows[-1]
+            next_cursor = self.encode_page_cursor(
+                [sort_column, descending, last_row[-1], last_row[columns.all_names.index('serialNumber')]])
+
+        return {
+            'columns': columns.names,
+            'rows': self.split_expired_flag(columns, [row[:-1] for row in rows]),
+            'next_cursor': next_cursor,
+            'total': total
+        }
+
+    def stream_query(self, query, params=None):
+        # Выполняет запрос на именованном (серверном) курсоре: первым элементом отдаёт описание столбцов,
+        # затем строки порциями по stream_fetch_size, поэтому в памяти процесса находится только одна порция.
+        # Соединение занято, пока генератор не будет дочитан или закрыт, то есть пока клиент скачивает ответ,
+        # поэтому одновременных потоков не больше pool-stream-max-size, остальные ждут свободного места
+        core.dbpool.db_pool.acquire_stream()
         try:
             with DatabaseContextManager() as db:
-                db.cursor.execute('SELECT * FROM pos_not_fiscals')
-                data = db.cursor.fetchall()
-
-                # Получаем названия столбцов из информационной схемы PostgreSQL
-                db.cursor.execute('''
-                    SELECT column_name 
-                    FROM information_schema.columns 
-                    WHERE table_name = 'pos_not_fiscals'
-                    ORDER BY ordinal_position
-                ''')
-                columns = [column[0] for column in db.cursor.fetchall()]
-
-            return data, columns
+                cursor = db.conn.cursor(name=f'getad_stream_{uuid.uuid4().hex}')
+                cursor.execute(query, params)
+                rows = cursor.fetchmany(self.stream_fetch_size)
+                yield cursor.description
+
+                while rows:
+                    yield rows
+                    rows = cursor.fetchmany(self.stream_fetch_size)
+        finally:
+            core.dbpool.db_pool.release_stream()
+
+    def stream_rows(self, chunks, table_name, convert):
+        # Разворачивает порции строк в поток строк, преобразуя каждую порцию функцией convert. Ошибку чтения
+        # пробрасываем дальше: ответ, который уже начал отправляться, должен оборваться, а не завершиться
+        # как полный
+        try:
+            for chunk in chunks:
+                yield from convert(chunk)
         except Exception:
-            core.logger.db_service.error("При чтении таблицы 'pos_not_fiscals' произошло исключение", exc_info=True)
-            return [], []
+            core.logger.db_service.error(
+                f"Не удалось дочитать результат запроса к таблице [{table_name}]", exc_info=True)
+            raise
+        finally:
+            chunks.close()
+
+    def open_stream(self, table_name, query, params=None, expired_flag=False):
+        # Возвращает генератор видимых столбцов строк и имена столбцов; ошибка выполнения запроса
+        # выбрасывается сразу, а не при чтении строк. Признак устаревания должен быть последним столбцом
+        chunks = self.stream_query(query, params)
+        description = next(chunks)
+        columns = column_catalog.resolve(table_name, description[:-1] if expired_flag else description)
+
+        if expired_flag:
+            convert = lambda chunk: self.split_expired_flag(columns, chunk)
+        else:
+            convert = columns.project
+        return self.stream_rows(chunks, table_name, convert), columns.names
 
-    def search_querie(self, search_query):
-        try:
+    def export_fiscals(self, export_columns, filters=None, serials=None, sort_column='serialNumber', descending=False):
+        # Выгрузка записей ФР для CSV: запрошенные столбцы (неизвестные и служебные пропускаются) записей,
+        # выбранных по списку серийных номеров или по фильтрам таблицы. Возвращает имена столбцов и генератор строк
+        with DatabaseContextManager() as db:
+            columns = column_catalog.get(db, 'pos_fiscals')
+
+        selected = [column for column in export_columns if column in columns.positions] or columns.names
+        if sort_column not in columns.positions:
+            sort_column = 'serialNumber'
+
+        conditions, params = self.fiscals_filter_conditions(columns, filters or [])
+        if serials is not None:
+            conditions.append('"serialNumber" = ANY(%s)')
+            params.append([str(serial) for serial in serials])
+
+        sort_key = f'''lower(COALESCE("{sort_column}"::TEXT, 'None'))'''
+        direction = 'DESC' if descending else 'ASC'
+        query = f'''
+            SELECT {', '.join(f'"{column}"' for column in selected)} FROM pos_fiscals
+            {"WHERE " + " AND ".join(conditions) if conditions else ""}
+            ORDER BY {sort_key} {direction}, "serialNumber" {direction}
+        '''
+
+        chunks = self.stream_query(query, params)
+        next(chunks)
+        return selected, self.stream_rows(chunks, 'pos_fiscals', lambda chunk: chunk)
+
+    def open_records_stream(self, table_name, fields, query_tail='', params=None):
+        # Записи таблицы словарями {столбец: значение} потоком с серверного курсора. Если fields задан,
+        # выбираются только эти столбцы (неизвестные и служебные пропускаются), иначе все видимые
+        if fields is None:
+            rows, names = self.open_stream(table_name, f'SELECT * FROM {table_name} {query_tail}', params)
+        else:
             with DatabaseContextManager() as db:
-                # Получаем названия столбцов из информационной схемы PostgreSQL
-                db.cursor.execute('''
-                    SELECT column_name 
-                    FROM information_schema.columns 
-                    WHERE table_name = 'pos_fiscals'
-                    ORDER BY ordinal_position
-                ''')
-                columns = [column[0] for column in db.cursor.fetchall()]
+                columns = column_catalog.get(db, table_name)
 
-                # Создаём запрос SQL для поиска по всем столбцам
-                query = "SELECT * FROM pos_fiscals WHERE "
-                conditions = []
+            names = list(dict.fromkeys(field for field in fields if field in columns.positions))
+            if not names:
+                raise ValueError("Ни одно из запрошенных полей не найдено")
 
-                for column in columns:
-                    conditions.append(f'"{column}"::TEXT ILIKE %s')
+            select_list = ', '.join(f'"{name}"' for name in names)
+            chunks = self.stream_query(f'SELECT {select_list} FROM {table_name} {query_tail}', params)
+            next(chunks)
+            rows = self.stream_rows(chunks, table_name, lambda chunk: chunk)
 
-                # Соединяем условия поиска оператором OR
-                query += " OR ".join(conditions)
+        return self.rows_to_records(names, rows)
+
+    def rows_to_records(self, names, rows):
+        try:
+            for row in rows:
+                yield dict(zip(names, row))
+        finally:
+            rows.close()
 
-                # Создаём список параметров для запроса (по одному '%значение%' на каждый столбец)
-                params = [f'%{search_query}%'] * len(columns)
+    def get_pos_records(self, fields=None):
+        return self.open_records_stream('pos_not_fiscals', fields)
 
-                # Выполняем запрос
-                db.cursor.execute(query, params)
-                search_results = db.cursor.fetchall()
+    def get_only_pos(self):
+        try:
+            return self.open_stream('pos_not_fiscals', 'SELECT * FROM pos_not_fiscals')
+        except Exception:
+            core.logger.db_service.error("При чтении таблицы 'pos_not_fiscals' произошло исключение", exc_info=True)
+            return [], []
 
-                # Создаём новый список для данных с проверкой на устаревание
-                modified_data = []
-                for row in search_results:
-                    modified_row = list(row)
+    # Поля, по которым можно искать с префиксом вида inn:7701..., сравнивается начало значения без учёта регистра
+    search_fields = {'serial': 'serialNumber', 'inn': 'INN', 'rnm': 'RNM', 'fn': 'fn_serial',
+                     'model': 'modelName', 'url': 'url_rms'}
+    search_token = re.compile(r'(\w+):("[^"]*"|\S+)|"([^"]*)"|(\S+)')
+    search_comparison = re.compile(r'^(<=|>=|<|>|=)?(.*)$')
+
+    def search_date_condition(self, column, value):
+        # end:<2026-12-01, end:>=2026-01-01 или end:2026-12-01 (весь день)
+        operator, date_text = self.search_comparison.match(value).groups()
+        day = datetime.datetime.strptime(date_text, '%Y-%m-%d')
+        next_day = day + datetime.timedelta(days=1)
+
+        if operator == '<':
+            return [f'{column} < %s'], [day]
+        if operator == '<=':
+            return [f'{column} < %s'], [next_day]
+        if operator == '>':
+            return [f'{column} >= %s'], [next_day]
+        if operator == '>=':
+            return [f'{column} >= %s'], [day]
+        return [f'{column} >= %s', f'{column} < %s'], [day, next_day]
+
+    def search_stale_condition(self, column, value):
+        # stale:>14d - запись не обновлялась дольше 14 дней, stale:<12h - обновлялась за последние 12 часов
+        operator, period = self.search_comparison.match(value).groups()
+        period_match = re.fullmatch(r'(\d+)([dh]?)', period.lower())
+        if not period_match or operator == '=':
+            raise ValueError(f"Некорректный период '{value}'")
+
+        amount, unit = int(period_match.group(1)), period_match.group(2)
+        cutoff = datetime.datetime.now() - (
+            datetime.timedelta(hours=amount) if unit == 'h' else datetime.timedelta(days=amount))
+
+        if operator in ('<', '<='):
+            return [f'{column} >= %s'], [cutoff]
+        return [f'{column} < %s'], [cutoff]
+
+    def parse_search_query(self, search_query):
+        # Разбирает строку поиска на условия по отдельным столбцам и термы для поиска по всем столбцам,
+        # при некорректной дате или периоде выбрасывает ValueError
+        conditions, params, terms = [], [], []
+
+        for match in self.search_token.finditer(search_query):
+            key, value, quoted, word = match.groups()
+            key = key.lower() if key else None
+            if value and len(value) > 1 and value.startswith('"') and value.endswith('"'):
+                value = value[1:-1]
+
+            if key in self.search_fields:
+                conditions.append(f'lower("{self.search_fields[key]}") LIKE lower(%s)')
+                params.append(f'{self.escape_like(value)}%')
+            elif key == 'end':
+                key_conditions, key_params = self.search_date_condition('"_dateTime_end_ts"', value)
+                conditions.extend(key_conditions)
+                params.extend(key_params)
+            elif key == 'stale':
+                key_conditions, key_params = self.search_stale_condition('"_current_time_ts"', value)
+                conditions.extend(key_conditions)
+                params.extend(key_params)
+            elif key is not None:
+                # Неизвестный префикс (например, адрес вида http://...) ищем как обычный текст
+                terms.append(match.group(0))
+            else:
+                terms.append(quoted if quoted is not None else word)
 
-                    # Определяем индексы важных столбцов
-                    licenses_data_index = columns.index('licenses') if 'licenses' in columns else -1
-                    current_time_index = columns.index('current_time') if 'current_time' in columns else -1
-                    v_time_index = columns.index('v_time') if 'v_time' in columns else -1
+        return conditions, params, [term for term in terms if term]
 
-                    # Обработка licenses
-                    if licenses_data_index >= 0 and row[licenses_data_index]:
-                        modified_row[licenses_data_index] = row[licenses_data_index]
+    def search_querie(self, search_query):
+        try:
+            try:
+                conditions, params, terms = self.parse_search_query(search_query)
+            except ValueError as e:
+                core.logger.db_service.warning(f"Некорректный поисковый запрос '{search_query}': {e}")
+                return [], []
+
+            # Термы без префикса ищем как подстроку в поисковом документе записи (значения всех столбцов,
+            # кроме исключённых в search-exclude-columns), а точные совпадения серийного номера, ИНН,
+            # РНМ и номера ФН с ними выводим первыми
+            for term in terms:
+                conditions.append('"_search_doc" LIKE lower(%s)')
+                params.append(f'%{self.escape_like(term)}%')
+
+            query = f'''
+                SELECT *, {self.expired_flag_sql()} FROM pos_fiscals
+                {"WHERE " + " AND ".join(conditions) if conditions else ""}
+                ORDER BY CASE WHEN ARRAY[lower("serialNumber"), lower("INN"), lower("RNM"), lower("fn_serial")]
+                                   && %s::TEXT[] THEN 0 ELSE 1 END, "serialNumber"
+            '''
+            params = [self.staleness_cutoff()] + params + [[term.lower() for term in terms]]
+
+            return self.open_stream('pos_fiscals', query, params, expired_flag=True)
 
-                    # Проверка устаревания записи
-                    time_to_check = None
-                    if v_time_index >= 0 and current_time_index >= 0:
-                        time_to_check = row[v_time_index] if row[v_time_index] not in (None, '', 'None') else row[
-                            current_time_index]
+        except Exception:
+            core.logger.db_service.error("Не удалось сделать поисковый запрос", exc_info=True)
 
-                    is_expired = False
-                    if time_to_check:
-                        is_expired = not self.if_show_fn_to_date(time_to_check, self.dont_valid_fn)
+    def get_suggestions(self, prefix):
+        # Подсказки для строки поиска: значения, начинающиеся с prefix, по каждому полю берутся
+        # из индекса (lower(...) text_pattern_ops) в порядке этого индекса, не более suggest_limit
+        prefix = prefix.strip()
+        if not prefix:
+            return []
 
-                    # Добавляем признак устаревания в строку
-                    modified_row.append(is_expired)
+        cache_key = prefix.lower()
+        suggestions = self.suggest_cache.get(cache_key)
+        if suggestions is not None:
+            return suggestions
+
+        queries = []
+        params = []
+        for field, search_key, table_name, column, target in self.suggest_fields:
+            queries.append(f'''(
+                SELECT DISTINCT ON (lower("{column}"), "{target}") '{field}', "{column}", "{target}"
+                FROM {table_name}
+                WHERE lower("{column}") LIKE lower(%s)
+                ORDER BY lower("{column}") USING ~<~, "{target}"
+                LIMIT %s)''')
+            params.extend([f'{self.escape_like(prefix)}%', self.suggest_limit])
 
-                    modified_data.append(modified_row)
+        with DatabaseContextManager() as db:
+            db.cursor.execute(' UNION ALL '.join(queries), params)
+            rows = db.cursor.fetchall()
 
-                return modified_data, columns
+        search_keys = {field: search_key for field, search_key, _, _, _ in self.suggest_fields}
+        suggestions = []
+        for field, value, target in rows[:self.suggest_limit]:
+            suggestions.append({
+                'field': field,
+                'value': value,
+                'query': f'{search_keys[field]}:"{target}"'
+            })
 
-        except Exception:
-            core.logger.db_service.error("Не удалось сделать поисковый запрос", exc_info=True)
+        self.suggest_cache.set(cache_key, suggestions, self.suggest_cache_ttl)
+        return suggestions
 
     def get_expire_fn(self, start_date, end_date, show_marked):
         try:
-            with DatabaseContextManager() as db:
-                db.cursor.execute('''
-                    CREATE TABLE IF NOT EXISTS fn_sale_task (
-                        "serialNumber" TEXT PRIMARY KEY,
-                        "fn_serial" TEXT
-                    )
-                ''')
-
-                # Добавляем создание таблицы clients, если она не существует
-                db.cursor.execute('''
-                    CREATE TABLE IF NOT EXISTS clients (
-                        "id" TEXT PRIMARY KEY,
-                        "url_rms" TEXT,
-                        "INN" TEXT,
-                        "organizationName" TEXT,
-                        "serverName" TEXT,
-                        "version" TEXT,
-                        "manual_edit" INTEGER DEFAULT 0,
-                        "last_updated" TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )
-                ''')
-
             with DatabaseContextManager() as db:
                 db.cursor.execute('SELECT "serialNumber" FROM fn_sale_task')
                 marked_records = {row[0] for row in db.cursor.fetchall()}
@@ -521,22 +957,24 @@ class DbQueries(DatabaseContextManager):
                            pos_fiscals."fn_serial", 
                            pos_fiscals."organizationName", 
                            pos_fiscals."INN", 
-                           date(pos_fiscals."dateTime_end") as dateTime_end,
-                           pos_fiscals."current_time", 
-                           pos_fiscals."v_time",
+                           pos_fiscals."_dateTime_end_ts"::DATE as dateTime_end,
                            pos_fiscals."url_rms",
                            pos_fiscals."address"
                     FROM pos_fiscals 
                     LEFT JOIN clients ON pos_fiscals."url_rms" = clients."url_rms"
-                    WHERE date(pos_fiscals."dateTime_end") >= date(%s) AND date(pos_fiscals."dateTime_end") <= date(%s)
+                    WHERE pos_fiscals."_dateTime_end_ts" >= %s::DATE 
+                      AND pos_fiscals."_dateTime_end_ts" < %s::DATE + 1
                 """
 
+                # Пропускаем устаревшие записи: v_time (или current_time) старше day_filter_expire дней
+                base_query += f' AND {self.staleness_timestamp_sql()} >= %s'
+
                 if not show_marked:
                     base_query += ' AND pos_fiscals."serialNumber" NOT IN (SELECT "serialNumber" FROM fn_sale_task)'
 
-                base_query += ' ORDER BY pos_fiscals."dateTime_end" ASC'
+                base_query += ' ORDER BY pos_fiscals."_dateTime_end_ts" ASC'
 
-                db.cursor.execute(base_query, (start_date, end_date))
+                db.cursor.execute(base_query, (start_date, end_date, self.staleness_cutoff()))
                 rows = db.cursor.fetchall()
 
                 core.logger.db_service.debug(
@@ -545,20 +983,11 @@ class DbQueries(DatabaseContextManager):
                 for row in rows:
                     record = dict(
                         zip(['serialNumber', 'client', 'RNM', 'fn_serial', 'organizationName', 'INN',
-                             'dateTime_end', 'current_time', 'v_time', 'url_rms', 'address'], row))
+                             'dateTime_end', 'url_rms', 'address'], row))
 
-                    # Определяем, какое время использовать
-                    time_to_check = record['v_time'] if record['v_time'] not in (None, '', 'None') else record[
-                        'current_time']
-
-                    # Проверяем условие через функцию if_show_fn_to_date
-                    if self.if_show_fn_to_date(time_to_check, self.dont_valid_fn):
-                        # Удаляем временные поля из словаря
-                        del record['current_time']
-                        del record['v_time']
-                        # Добавляем информацию о том, отмечена ли запись
-                        record['is_marked'] = record['serialNumber'] in marked_records
-                        records.append(record)
+                    # Добавляем информацию о том, отмечена ли запись
+                    record['is_marked'] = record['serialNumber'] in marked_records
+                    records.append(record)
 
             core.logger.db_service.debug(
                 f"Поиск клиентов ({len(records)}), которым потребуется замена ФН в интервале от '{start_date}' до '{end_date}', завершён:")
@@ -569,71 +998,21 @@ class DbQueries(DatabaseContextManager):
 
     def search_dont_update(self, field, days):
         try:
-            with DatabaseContextManager() as db:
-                # Получаем названия столбцов из информационной схемы PostgreSQL
-                db.cursor.execute('''
-                    SELECT column_name 
-                    FROM information_schema.columns 
-                    WHERE table_name = 'pos_fiscals'
-                    ORDER BY ordinal_position
-                ''')
-                columns = [column[0] for column in db.cursor.fetchall()]
-
-                # Строим запрос для поиска устаревших записей
-                # Используем синтаксис PostgreSQL для работы с датами
-                query = f'''
-                    SELECT * FROM pos_fiscals 
-                    WHERE "{field}"::timestamp < (CURRENT_TIMESTAMP - INTERVAL '{days} days')
-                '''
-
-                # Выполняем запрос
-                db.cursor.execute(query)
-                search_results = db.cursor.fetchall()
-
-                # Создаем новый список для данных с проверкой на устаревание
-                modified_data = []
-                for row in search_results:
-                    modified_row = list(row)
-
-                    # Определяем индексы важных столбцов
-                    licenses_data_index = columns.index('licenses') if 'licenses' in columns else -1
-                    current_time_index = columns.index("current_time") if "current_time" in columns else -1
-                    v_time_index = columns.index('v_time') if 'v_time' in columns else -1
-
-                    # Обработка licenses
-                    if licenses_data_index >= 0 and row[licenses_data_index]:
-                        modified_row[licenses_data_index] = row[licenses_data_index]
-
-                    # Проверка устаревания записи
-                    time_to_check = None
-                    if v_time_index >= 0 and current_time_index >= 0:
-                        time_to_check = row[v_time_index] if row[v_time_index] not in (None, '', 'None') else row[
-                            current_time_index]
-
-                    is_expired = False
-                    if time_to_check:
-                        is_expired = not self.if_show_fn_to_date(time_to_check, self.dont_valid_fn)
-
-                    # Добавляем признак устаревания в строку
-                    modified_row.append(is_expired)
-
-                    modified_data.append(modified_row)
-
-                return modified_data, columns
+            # Строим запрос для поиска устаревших записей по типизированному столбцу времени,
+            # так выборка идёт по индексу, а нераспознанные даты в неё не попадают
+            query = f'''
+                SELECT *, {self.expired_flag_sql()} FROM pos_fiscals 
+                WHERE "_{field}_ts" < %s
+            '''
+            params = (self.staleness_cutoff(), datetime.datetime.now() - datetime.timedelta(days=days))
+
+            return self.open_stream('pos_fiscals', query, params, expired_flag=True)
         except Exception:
             core.logger.db_service.error("Не удалось сделать поисковый запрос устаревших записей", exc_info=True)
 
     def toggle_task(self, serial_number, fn_serial, checked, bitrix24):
         try:
             with DatabaseContextManager() as db:
-                # Создаем таблицу если её нет
-                db.cursor.execute('''
-                    CREATE TABLE IF NOT EXISTS fn_sale_task (
-                        "serialNumber" TEXT PRIMARY KEY,
-                        "fn_serial" TEXT
-                    )
-                ''')
-
                 if checked:
                     db.cursor.execute(
                         '''INSERT INTO fn_sale_task ("serialNumber", "fn_serial") 
@@ -659,11 +1038,11 @@ class DbQueries(DatabaseContextManager):
             core.logger.db_service.error("Ошибка при обновлении таблицы fn_sale_task", exc_info=True)
             return {'status': 'error', 'message': str(e)}
 
-    def save_client_name(self, url_rms, inn, org_name, existing_record=None):
+    def save_client_name(self, url_rms, inn, org_name, existing_record=None, use_cache=True):
         import core.connectors
         iikorms = core.connectors.IikoRms()
 
-        server_name, version = iikorms.get_rms_name(url_rms)
+        server_name, version = iikorms.get_rms_name(url_rms, use_cache)
 
         with DatabaseContextManager() as db:
             # Если запись существует и manual_edit = 1, сохраняем старое значение serverName
@@ -690,6 +1069,7 @@ class DbQueries(DatabaseContextManager):
                         INSERT INTO clients 
                         ("id", "url_rms", "INN", "organizationName", "serverName", "version", "manual_edit") 
                         VALUES (%s, %s, %s, %s, %s, %s, 0)
+                        ON CONFLICT ("url_rms") DO NOTHING
                     ''', (unique_id, url_rms, inn, org_name, server_name, version))
             db.conn.commit()
             core.logger.db_service.debug(f"Успешно обновлена информация для {url_rms}")
@@ -697,21 +1077,6 @@ class DbQueries(DatabaseContextManager):
     def add_new_clients(self, url_rms, inn, org_name):
         try:
             with DatabaseContextManager() as db:
-                # Создаём таблицу clients, если она не существует
-                db.cursor.execute('''
-                        CREATE TABLE IF NOT EXISTS clients (
-                            "id" TEXT PRIMARY KEY,
-                            "url_rms" TEXT,
-                            "INN" TEXT,
-                            "organizationName" TEXT,
-                            "serverName" TEXT,
-                            "version" TEXT,
-                            "manual_edit" INTEGER DEFAULT 0,
-                            "last_updated" TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                        )
-                    ''')
-                db.conn.commit()
-
                 # Проверяем, существует ли уже запись с таким url_rms
                 db.cursor.execute('SELECT "id" FROM clients WHERE "url_rms" = %s', (url_rms,))
                 existing_record = db.cursor.fetchone()
@@ -719,7 +1084,8 @@ class DbQueries(DatabaseContextManager):
                 if not existing_record:
                     for attempt in range(3):
                         try:
-                            self.save_client_name(url_rms, inn, org_name)
+                            # Повторные попытки выполняем в обход кэша, иначе они вернут закэшированную ошибку
+                            self.save_client_name(url_rms, inn, org_name, use_cache=attempt == 0)
                             time.sleep(1)
                             break
                         except Exception:
@@ -734,6 +1100,7 @@ class DbQueries(DatabaseContextManager):
                                     INSERT INTO clients 
                                     ("id", "url_rms", "INN", "organizationName", "serverName", "version", "manual_edit") 
                                     VALUES (%s, %s, %s, %s, %s, %s, 0)
+                                    ON CONFLICT ("url_rms") DO NOTHING
                                 ''', (unique_id, url_rms, inn, org_name, None, None))
                             core.logger.db_service.debug(f"Добавлена запись с 'None' для '{url_rms}'")
         except Exception:
@@ -743,20 +1110,6 @@ class DbQueries(DatabaseContextManager):
     def edit_client_name(self, url_rms, server_name):
         try:
             with DatabaseContextManager() as db:
-                # Создаем таблицу clients если её нет
-                db.cursor.execute('''
-                    CREATE TABLE IF NOT EXISTS clients (
-                        "id" TEXT PRIMARY KEY,
-                        "url_rms" TEXT,
-                        "INN" TEXT,
-                        "organizationName" TEXT,
-                        "serverName" TEXT,
-                        "version" TEXT,
-                        "manual_edit" INTEGER DEFAULT 0,
-                        "last_updated" TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )
-                ''')
-
                 # Проверяем, существует ли запись
                 db.cursor.execute(
                     'SELECT "id" FROM clients WHERE "url_rms" = %s',
@@ -778,6 +1131,9 @@ class DbQueries(DatabaseContextManager):
                         INSERT INTO clients 
                         ("id", "url_rms", "serverName", "manual_edit") 
                         VALUES (%s, %s, %s, 1)
+                        ON CONFLICT ("url_rms") 
+                        DO UPDATE SET "serverName" = EXCLUDED."serverName", "manual_edit" = 1, 
+                                      "last_updated" = CURRENT_TIMESTAMP
                     ''', (unique_id, url_rms, server_name))
 
                 return {'success': True}
@@ -794,16 +1150,6 @@ class DbQueries(DatabaseContextManager):
             api_key = str(uuid.uuid4())
 
             with DatabaseContextManager() as db:
-                # Создание таблицы api_keys, если она не существует
-                db.cursor.execute('''
-                    CREATE TABLE IF NOT EXISTS api_keys (
-                        "api_key" TEXT PRIMARY KEY,
-                        "name" TEXT,
-                        "admin_tag" INTEGER,
-                        "active" INTEGER
-                    )
-                ''')
-
                 # Сохранение API-ключа в базу данных
                 db.cursor.execute('''
                     INSERT INTO api_keys ("api_key", "name", "admin_tag", "active") 
@@ -908,49 +1254,103 @@ class DbQueries(DatabaseContextManager):
             core.logger.db_service.error("Не удалось получить расширенную информацию о серийных номерах", exc_info=True)
             return {}
 
-    def get_fiscals_by_serial_numbers(self, serial_numbers):
-        try:
-            with DatabaseContextManager() as db:
-                # Получаем названия столбцов из информационной схемы
-                db.cursor.execute('''
-                    SELECT column_name 
-                    FROM information_schema.columns 
-                    WHERE table_name = 'pos_fiscals'
-                    ORDER BY ordinal_position
-                ''')
-                columns = [column[0] for column in db.cursor.fetchall()]
-
-                # Создаем параметры для запроса
-                placeholders = ','.join(['%s'] * len(serial_numbers))
-
-                # Формируем SQL-запрос
-                query = f'''
-                    SELECT * 
-                    FROM pos_fiscals 
-                    WHERE "serialNumber" IN ({placeholders})
-                '''
-
-                # Выполняем запрос
-                db.cursor.execute(query, tuple(serial_numbers))
-                results = db.cursor.fetchall()
-
-                # Преобразуем результаты в список словарей
-                fiscals_data = []
-                for row in results:
-                    fiscal_dict = {}
-                    for i, column in enumerate(columns):
-                        # Для полей типа JSON или списков преобразуем в строковый формат
-                        if isinstance(row[i], (dict, list)):
-                            fiscal_dict[column] = json.dumps(row[i], ensure_ascii=False)
-                        else:
-                            fiscal_dict[column] = row[i]
-                    fiscals_data.append(fiscal_dict)
+    def get_fiscals_by_serial_numbers(self, serial_numbers, fields=None):
+        # Серийные номера передаются массивом (= ANY) порциями по serial_chunk_size: текст запроса не зависит
+        # от длины списка, а в памяти одновременно находится не больше одной порции. Записи возвращаются
+        # потоком в порядке serialNumber, если список был отсортирован
+        query_tail = 'WHERE "serialNumber" = ANY(%s) ORDER BY "serialNumber" COLLATE "C"'
+        serial_chunks = [list(serial_numbers[index:index + self.serial_chunk_size])
+                         for index in range(0, len(serial_numbers), self.serial_chunk_size)] or [[]]
 
-                return fiscals_data
+        # Первая порция открывается сразу, чтобы ошибки запроса и полей возникли до начала ответа
+        first_records = self.open_records_stream('pos_fiscals', fields, query_tail, (serial_chunks[0],))
+        return self.chain_records(first_records, serial_chunks[1:], fields, query_tail)
 
-        except Exception:
-            core.logger.db_service.error("Не удалось получить данные о ККТ по серийным номерам", exc_info=True)
-            return []
+    def chain_records(self, first_records, serial_chunks, fields, query_tail):
+        try:
+            yield from first_records
+            for serial_chunk in serial_chunks:
+                records = self.open_records_stream('pos_fiscals', fields, query_tail, (serial_chunk,))
+                try:
+                    yield from records
+                finally:
+                    records.close()
+        finally:
+            first_records.close()
+
+    def get_changes(self, cursor=None, limit=500):
+        # Изменения записей ККТ и станций после курсора в порядке (номер транзакции, таблица, ключ). Отдаются
+        # только изменения транзакций старше самой старой незавершённой: ещё не зафиксированная транзакция
+        # может иметь меньший номер, чем уже отданные изменения. Из каждого источника берём не больше
+        # limit + 1 изменений, после слияния первые limit из них не имеют пропусков. Ключи и имена таблиц
+        # сравниваются с COLLATE "C", то есть посимвольно, как при слиянии и сравнении курсора в Python
+        since_txid, since_table, since_key = '0', '', ''
+        if cursor:
+            since_txid, since_table, since_key = self.decode_page_cursor(cursor, (str, str, str))
+            if not since_txid.isdigit():
+                raise ValueError("Некорректный курсор страницы")
+
+        changes = []
+        with DatabaseContextManager() as db:
+            if cursor:
+                db.cursor.execute('SELECT "purged_txid" FROM change_feed_state WHERE "id" = 1')
+                purged_txid = int(db.cursor.fetchone()[0])
+                if purged_txid and int(since_txid) <= purged_txid:
+                    raise ChangesCursorExpired(
+                        "Курсор старше срока хранения отметок об удалении, требуется полная синхронизация")
+
+            db.cursor.execute('SELECT pg_snapshot_xmin(pg_current_snapshot())')
+            horizon = db.cursor.fetchone()[0]
+
+            for table_name, key_column in (("pos_fiscals", "serialNumber"), ("pos_not_fiscals", "filename")):
+                # Внутри одной транзакции таблицы идут в порядке имён: изменения таблицы после таблицы курсора
+                # с тем же номером транзакции ещё не отданы, а таблицы перед ней - уже отданы целиком
+                if table_name == since_table:
+                    condition = f'("_change_txid", "{key_column}" COLLATE "C") > (%s::xid8, %s COLLATE "C")'
+                    params = (since_txid, since_key)
+                elif table_name > since_table:
+                    condition, params = '"_change_txid" >= %s::xid8', (since_txid,)
+                else:
+                    condition, params = '"_change_txid" > %s::xid8', (since_txid,)
+
+                db.cursor.execute(f'''
+                    SELECT * FROM {table_name}
+                    WHERE {condition} AND "_change_txid" < %s::xid8
+                    ORDER BY "_change_txid", "{key_column}" COLLATE "C"
+                    LIMIT %s
+                ''', params + (horizon, limit + 1))
+                rows = db.cursor.fetchall()
+                columns = column_catalog.resolve(table_name, db.cursor.description)
+                txid_index = columns.all_names.index('_change_txid')
+
+                for row, values in zip(rows, columns.project(rows)):
+                    record = dict(zip(columns.names, values))
+                    changes.append({'table': table_name, 'key': record.get(key_column), 'txid': row[txid_index],
+                                    'deleted': False, 'record': record})
+
+            db.cursor.execute('''
+                SELECT "table_name", "record_key", "change_txid" FROM change_tombstones
+                WHERE ("change_txid", "table_name" COLLATE "C", "record_key" COLLATE "C")
+                      > (%s::xid8, %s COLLATE "C", %s COLLATE "C")
+                  AND "change_txid" < %s::xid8
+                ORDER BY "change_txid", "table_name" COLLATE "C", "record_key" COLLATE "C"
+                LIMIT %s
+            ''', (since_txid, since_table, since_key, horizon, limit + 1))
+            for table_name, record_key, change_txid in db.cursor.fetchall():
+                changes.append({'table': table_name, 'key': record_key, 'txid': change_txid,
+                                'deleted': True, 'record': None})
+
+        changes.sort(key=lambda change: (int(change['txid']), change['table'], change['key']))
+        has_more = len(changes) > limit
+        changes = changes[:limit]
+
+        if changes:
+            since_txid, since_table, since_key = changes[-1]['txid'], changes[-1]['table'], changes[-1]['key']
+        return {
+            'changes': changes,
+            'next_cursor': self.encode_page_cursor([since_txid, since_table, since_key]),
+            'has_more': has_more
+        }
 
     def get_bitrix_contractors(self, table_name, field_name, last_name):
         try:
@@ -1027,6 +1427,70 @@ class DbQueries(DatabaseContextManager):
                 "Ошибка при получении списка сотрудников и проектов из базы данных", exc_info=True)
 
 
+class ClientEnrichment(core.sys_manager.ResourceManagement):
+    # Очередь url_rms новых клиентов: имя сервера запрашивается у RMS отдельным потоком,
+    # чтобы сохранение данных о ККТ не ждало ответа серверов клиентов
+    def __init__(self):
+        super().__init__()
+        self.queries = DbQueries()
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._pending = set()
+        self._worker = None
+        self._pid = os.getpid()
+        self.stats = {"queued": 0, "duplicates": 0, "processed": 0, "errors": 0}
+
+    def _ensure_worker(self):
+        # Поток не переживает fork, поэтому в дочернем процессе очередь и поток создаются заново
+        if self._pid != os.getpid():
+            self._queue = queue.Queue()
+            self._pending = set()
+            self._worker = None
+            self._pid = os.getpid()
+            self.stats = {"queued": 0, "duplicates": 0, "processed": 0, "errors": 0}
+
+        if self._worker is None or not self._worker.is_alive():
+            self._worker = threading.Thread(target=self.process_queue, daemon=True)
+            self._worker.start()
+
+    def submit(self, url_rms, inn, org_name):
+        with self._lock:
+            self._ensure_worker()
+
+            # url_rms, который уже ждёт обработки, повторно не ставим
+            if url_rms in self._pending:
+                self.stats["duplicates"] += 1
+                return
+            self._pending.add(url_rms)
+            self.stats["queued"] += 1
+            self._queue.put((url_rms, inn, org_name))
+        core.logger.db_service.debug(f"Клиент '{url_rms}' поставлен в очередь на получение имени сервера")
+
+    def process_queue(self):
+        while True:
+            url_rms, inn, org_name = self._queue.get()
+            try:
+                self.queries.add_new_clients(url_rms, inn, org_name)
+                self.stats["processed"] += 1
+            except Exception:
+                self.stats["errors"] += 1
+                core.logger.db_service.error(
+                    f"Ошибка при добавлении клиента '{url_rms}' из очереди", exc_info=True)
+            finally:
+                with self._lock:
+                    self._pending.discard(url_rms)
+                self._queue.task_done()
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats["pending"] = len(self._pending)
+        return stats
+
+
+client_enrichment = ClientEnrichment()
+
+
 class DbUpdate(DbQueries):
     def __init__(self):
         super().__init__()
@@ -1039,8 +1503,32 @@ class DbUpdate(DbQueries):
         try: self.ftp_update = int(self.config.get("ftp-connect", "ftp_update", fallback=0))
         except: self.ftp_update = 0
 
+        try: self.batch_size = int(self.config.get("ingest", "batch-size", fallback=500))
+        except: self.batch_size = 500
+
+        try: self.clients_update_workers = int(self.config.get("db-update", "clients-update-workers", fallback=8))
+        except: self.clients_update_workers = 8
+
+        try: self.clients_update_host_interval = float(
+            self.config.get("db-update", "clients-update-host-interval-sec", fallback=1.5))
+        except: self.clients_update_host_interval = 1.5
+
+        try: self.clients_update_deadline = int(
+            self.config.get("db-update", "clients-update-deadline-sec", fallback=3600))
+        except: self.clients_update_deadline = 3600
+
+        try: self.changes_retention_days = int(
+            self.config.get("webserver", "api-changes-retention-days", fallback=30))
+        except: self.changes_retention_days = 30
+
+        self.clients_update_workers = max(self.clients_update_workers, 1)
+        self.changes_retention_days = max(self.changes_retention_days, 1)
         self.clients_update_process = 0
 
+    def count_batch(self, counters, result):
+        for name in counters:
+            counters[name] += result[name]
+
     def pos_tables_update(self):
         import core.connectors
         
@@ -1060,6 +1548,10 @@ class DbUpdate(DbQueries):
                             if not os.path.exists(temp_dir):
                                 os.makedirs(temp_dir)
 
+                            fiscals = {}
+                            not_fiscals = {}
+                            counters = {"written": 0, "unchanged": 0, "stale": 0}
+
                             # Скачивание файлов JSON на локальный компьютер
                             for filename in json_files:
                                 local_filename = os.path.join(temp_dir, filename)
@@ -1069,15 +1561,28 @@ class DbUpdate(DbQueries):
                                     try:
                                         json_data = json.load(file)
                                         if "serialNumber" in json_data:
-                                            self.save_fiscals({json_data["serialNumber"]: json_data})
+                                            fiscals[json_data["serialNumber"]] = json_data
                                         else:
                                             # Если ключ "serialNumber" отсутствует, сохраняем JSON в отдельную таблицу
-                                            self.save_not_fiscal(json_data, filename)
+                                            not_fiscals[filename] = json_data
                                     except json.JSONDecodeError:
                                         core.logger.db_service.error(
                                             f"Файл {filename} содержит некорректный JSON, пропускаем", exc_info=True)
                                 # Удаление временных файлов после чтения данных
                                 os.remove(local_filename)
+
+                                # Прочитанные файлы записываем в БД пакетами, неизменившиеся записи не перезаписываются
+                                if len(fiscals) + len(not_fiscals) >= self.batch_size:
+                                    self.count_batch(counters, self.save_batch(fiscals, not_fiscals))
+                                    fiscals = {}
+                                    not_fiscals = {}
+
+                            if fiscals or not_fiscals:
+                                self.count_batch(counters, self.save_batch(fiscals, not_fiscals))
+
+                            core.logger.db_service.info(
+                                f"Файлы с FTP обработаны: записано ({counters['written']}), без изменений "
+                                f"({counters['unchanged']}), пропущено из-за более ранней даты ({counters['stale']})")
                     except Exception:
                         core.logger.db_service.error(f"Не удалось загрузить файл c FTP", exc_info=True)
                         core.logger.db_service.info(
@@ -1093,10 +1598,17 @@ class DbUpdate(DbQueries):
                     self.clients_update_process = 1
 
                 core.logger.db_service.info("Обновление базы завершено")
+                core.logger.db_service.debug(f"Состояние пула соединений: {core.dbpool.db_pool.get_stats()}")
                 core.logger.db_service.info(
                     f"Следующее обновление будет произведено через ({self.dbupdate_period}) секунд")
                 time.sleep(self.dbupdate_period)
             
+    def clean_change_tombstones_on_schedule(self):
+        # Выполняется на каждом экземпляре независимо от reference: повторная очистка ничего не меняет
+        while True:
+            self.clean_change_tombstones(self.changes_retention_days)
+            time.sleep(3600)
+
     def update_clients_info_on_schedule(self):
         while True:
             self.clean_obsolete_clients()
@@ -1105,32 +1617,7 @@ class DbUpdate(DbQueries):
 
             core.logger.db_service.info(f"Начато обновление базы клиентов")
             try:
-                with DatabaseContextManager() as db:
-                    # Получаем все url_rms, INN и organizationName из pos_fiscals
-                    db.cursor.execute('''
-                            SELECT DISTINCT "url_rms", "INN", "organizationName" 
-                            FROM pos_fiscals 
-                            WHERE "url_rms" IS NOT NULL AND "url_rms" != ''
-                        ''')
-                    records = db.cursor.fetchall()
-                    core.logger.db_service.debug(f"Найдено клиентов: {len(records)}")
-
-                    # Обрабатываем каждую запись
-                    for record in records:
-                        url_rms, inn, org_name = record
-
-                        # Проверяем существующую запись и значение manual_edit
-                        db.cursor.execute(
-                            'SELECT "serverName", "version", "manual_edit" FROM clients WHERE "url_rms" = %s',
-                            (url_rms,))
-                        existing_record = db.cursor.fetchone()
-
-                        try:
-                            DbQueries().save_client_name(url_rms, inn, org_name, existing_record)
-                            time.sleep(1.5)
-                        except Exception:
-                            time.sleep(1.5)
-                            continue
+                self.refresh_clients_info()
                 core.logger.db_service.info(
                     f"Обновление базы клиентов завершено, следующее обновление через '24' часа")
                 time.sleep(60)
@@ -1139,18 +1626,106 @@ class DbUpdate(DbQueries):
                     "Ошибка при обновлении информации о клиентах, следующая попытка через '24' часа", exc_info=True)
                 time.sleep(60)
 
+    def refresh_clients_info(self):
+        import core.connectors
+        iikorms = core.connectors.IikoRms()
+
+        started = time.monotonic()
+        deadline = started + self.clients_update_deadline
+
+        with DatabaseContextManager() as db:
+            # Получаем все url_rms, INN и organizationName из pos_fiscals, по одной записи на url_rms
+            db.cursor.execute('''
+                    SELECT DISTINCT ON ("url_rms") "url_rms", "INN", "organizationName" 
+                    FROM pos_fiscals 
+                    WHERE "url_rms" IS NOT NULL AND "url_rms" != ''
+                    ORDER BY "url_rms"
+                ''')
+            records = db.cursor.fetchall()
+        core.logger.db_service.debug(f"Найдено клиентов: {len(records)}")
+
+        def get_host(url_rms):
+            return urllib.parse.urlsplit(url_rms).netloc.lower() or url_rms
+
+        # Чередуем хосты, чтобы потоки не простаивали в ожидании очереди к одному и тому же серверу
+        records_by_host = {}
+        for record in records:
+            records_by_host.setdefault(get_host(record[0]), []).append(record)
+        records = [record for group in itertools.zip_longest(*records_by_host.values())
+                   for record in group if record is not None]
+
+        # Запросы к одному хосту разносим не менее чем на clients_update_host_interval секунд
+        host_lock = threading.Lock()
+        host_next_request = {}
+
+        def fetch_client_name(record):
+            url_rms, inn, org_name = record
+            host = get_host(url_rms)
+
+            with host_lock:
+                request_time = max(time.monotonic(), host_next_request.get(host, 0))
+                host_next_request[host] = request_time + self.clients_update_host_interval
+
+            if request_time >= deadline:
+                return record, None
+            time.sleep(max(request_time - time.monotonic(), 0))
+
+            try:
+                return record, iikorms.get_rms_name(url_rms)
+            except Exception:
+                return record, False
+
+        results = []
+        counters = {"updated": 0, "failed": 0, "skipped": 0}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.clients_update_workers) as executor:
+            for record, result in executor.map(fetch_client_name, records):
+                if result is None:
+                    counters["skipped"] += 1
+                    continue
+                if result is False:
+                    counters["failed"] += 1
+                    continue
+
+                server_name, version = result
+                results.append((str(uuid.uuid4()), record[0], record[1], record[2], server_name, version))
+                # Результаты записываем в БД пакетами, не дожидаясь окончания опроса всех серверов
+                if len(results) >= 100:
+                    counters["updated"] += self.save_clients_info(results)
+                    results = []
+
+        if results:
+            counters["updated"] += self.save_clients_info(results)
+
+        elapsed = time.monotonic() - started
+        core.logger.db_service.info(
+            f"Опрошено серверов клиентов: ({len(records)}) за ({round(elapsed)}) сек. "
+            f"({round(len(records) / elapsed, 1) if elapsed else 0} в сек.), обновлено ({counters['updated']}), "
+            f"с ошибкой ({counters['failed']}), не успели опросить до истечения "
+            f"({self.clients_update_deadline}) сек. ({counters['skipped']})")
+        return counters
+
+    def save_clients_info(self, results):
+        with DatabaseContextManager() as db:
+            # Для записей с manual_edit = 1 сохраняем старое значение serverName
+            psycopg2.extras.execute_values(db.cursor, '''
+                    INSERT INTO clients 
+                    ("id", "url_rms", "INN", "organizationName", "serverName", "version")
+                    VALUES %s
+                    ON CONFLICT ("url_rms") 
+                    DO UPDATE SET "version" = EXCLUDED."version",
+                                  "serverName" = CASE WHEN clients."manual_edit" = 1 
+                                                      THEN clients."serverName" 
+                                                      ELSE EXCLUDED."serverName" END,
+                                  "INN" = EXCLUDED."INN",
+                                  "organizationName" = EXCLUDED."organizationName",
+                                  "last_updated" = CURRENT_TIMESTAMP
+                ''', results, template='(%s, %s, %s, %s, %s, %s)', page_size=len(results))
+        core.logger.db_service.debug(f"Обновлена информация о ({len(results)}) клиентах")
+        return len(results)
+
     def update_bitrix_employees_table(self, employees):
         try:
             with DatabaseContextManager() as db:
-                # Создаём таблицу bitrix_employees, если она не существует
-                db.cursor.execute('''CREATE TABLE IF NOT EXISTS bitrix_employees (
-                                    "id" TEXT PRIMARY KEY,
-                                    "NAME" TEXT,
-                                    "LAST_NAME" TEXT,
-                                    "UF_DEPARTMENT" TEXT,
-                                    "responsible" INTEGER DEFAULT 0
-                                )''')
-
                 if employees:
                     # Получаем все id, которые были до обновления
                     db.cursor.execute('SELECT "id", "NAME", "LAST_NAME" FROM bitrix_employees')
@@ -1213,14 +1788,6 @@ class DbUpdate(DbQueries):
     def update_bitrix_projects_table(self, projects):
         try:
             with DatabaseContextManager() as db:
-                # Создаём таблицу bitrix_employees, если она не существует
-                db.cursor.execute('''CREATE TABLE IF NOT EXISTS bitrix_projects (
-                                    "id" TEXT PRIMARY KEY,
-                                    "NAME" TEXT,
-                                    "SUBJECT_NAME" TEXT,
-                                    "observers" INTEGER DEFAULT 0
-                                )''')
-
                 if projects:
                     # Получаем все id, которые были до обновления
                     db.cursor.execute('SELECT "id", "NAME", "SUBJECT_NAME" FROM bitrix_projects')
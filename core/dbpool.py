@@ -0,0 +1,328 @@
+import core.sys_manager
+import core.logger
+import os
+import time
+import threading
+import psycopg2
+import psycopg2.pool
+import psycopg2.extensions
+import psycopg2.errors
+import psycopg2.extras
+import greenlet
+
+try:
+    import eventlet
+    import eventlet.support.psycopg2_patcher
+except ImportError:
+    eventlet = None
+
+
+def cooperative_sleep(seconds):
+    # Внутри green-потока eventlet обычный time.sleep остановил бы весь хаб веб-сервера,
+    # поэтому там уступаем управление через eventlet.sleep
+    if eventlet is not None and greenlet.getcurrent().parent is not None:
+        eventlet.sleep(seconds)
+    else:
+        time.sleep(seconds)
+
+
+def cooperative_wait(conn, timeout=-1):
+    # Ожидание ответа БД в green-режиме: green-поток eventlet уступает управление хабу, и пока запрос
+    # выполняется, веб-сервер обслуживает другие запросы. Обычные потоки ждут ответа как раньше
+    if greenlet.getcurrent().parent is not None:
+        eventlet.support.psycopg2_patcher.eventlet_wait_callback(conn)
+    else:
+        psycopg2.extras.wait_select(conn)
+
+
+def reset_wait_callback():
+    psycopg2.extensions.set_wait_callback(None)
+
+
+def enable_green_db():
+    # Включается только в процессе веб-сервера. Процессы, запущенные из него позже (обработчики очереди),
+    # работают с БД в обычном режиме
+    if eventlet is None:
+        return False
+
+    if psycopg2.extensions.get_wait_callback() is None and hasattr(os, "register_at_fork"):
+        os.register_at_fork(after_in_child=reset_wait_callback)
+    psycopg2.extensions.set_wait_callback(cooperative_wait)
+    return True
+
+
+class ConnectionPool(core.sys_manager.ResourceManagement):
+    def __init__(self):
+        super().__init__()
+        self.dbname = self.config.get("db-update", "db-name", fallback="getad")
+        self.host = self.config.get("db-update", "host", fallback="localhost")
+        self.port = self.config.get("db-update", "port", fallback="5432")
+        self.user = self.config.get("db-update", "user", fallback="postgres")
+        self.password = self.config.get("db-update", "password", fallback="")
+
+        try: self.min_size = int(self.config.get("db-update", "pool-min-size", fallback=1))
+        except: self.min_size = 1
+
+        try: self.max_size = int(self.config.get("db-update", "pool-max-size", fallback=10))
+        except: self.max_size = 10
+
+        try: self.idle_timeout = int(self.config.get("db-update", "pool-idle-timeout-sec", fallback=300))
+        except: self.idle_timeout = 300
+
+        try: self.checkout_timeout = int(self.config.get("db-update", "pool-timeout-sec", fallback=30))
+        except: self.checkout_timeout = 30
+
+        try: self.health_check_interval = int(self.config.get("db-update", "pool-health-check-sec", fallback=30))
+        except: self.health_check_interval = 30
+
+        try: self.stream_max_size = int(self.config.get("db-update", "pool-stream-max-size", fallback=3))
+        except: self.stream_max_size = 3
+
+        self.max_size = max(self.max_size, 1)
+        self.min_size = min(max(self.min_size, 0), self.max_size)
+        # Потоковые ответы держат соединение, пока клиент скачивает ответ, поэтому им отдаётся только часть пула:
+        # медленные клиенты не занимают соединения, нужные приёму данных и остальным запросам
+        self.stream_max_size = min(max(self.stream_max_size, 1), self.max_size)
+
+        self._lock = threading.Lock()
+        self._idle = []  # [(conn, время возврата в пул)]
+        self._in_use = 0
+        self._streams = 0
+        self._pid = os.getpid()
+        # Соединения, унаследованные от родительского процесса после fork, не закрываем:
+        # закрытие из дочернего процесса оборвало бы сессию родителя
+        self._inherited = []
+        self._reset_stats()
+
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def _reset_stats(self):
+        self.stats = {
+            "created": 0,
+            "closed": 0,
+            "checkouts": 0,
+            "waits": 0,
+            "wait_time_ms": 0.0,
+            "timeouts": 0,
+            "stream_waits": 0,
+            "stream_timeouts": 0,
+            "health_check_failures": 0,
+            "max_in_use": 0
+        }
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+        self._inherited.extend(conn for conn, _ in self._idle)
+        self._idle = []
+        self._in_use = 0
+        self._streams = 0
+        self._pid = os.getpid()
+        self._reset_stats()
+
+    def _connect(self):
+        try:
+            return psycopg2.connect(
+                dbname=self.dbname,
+                user=self.user,
+                password=self.password,
+                host=self.host,
+                port=self.port
+            )
+        except psycopg2.OperationalError as e:
+            # Проверяем, что ошибка связана с отсутствием базы данных
+            if not ("database" in str(e) and "does not exist" in str(e)):
+                # Если ошибка не связана с отсутствием БД, пробрасываем её дальше
+                raise
+
+            temp_conn = psycopg2.connect(
+                dbname='postgres',
+                user=self.user,
+                password=self.password,
+                host=self.host,
+                port=self.port
+            )
+            temp_conn.autocommit = True  # Необходимо для создания БД
+            try:
+                temp_cursor = temp_conn.cursor()
+                # Создаём новую базу данных
+                temp_cursor.execute(f'CREATE DATABASE "{self.dbname}"')
+                temp_cursor.close()
+                core.logger.db_service.info(f"Создана новая база данных: {self.dbname}")
+            except (psycopg2.errors.DuplicateDatabase, psycopg2.errors.UniqueViolation):
+                # Базу одновременно с нами уже создал другой процесс или поток
+                pass
+            finally:
+                temp_conn.close()
+
+            # Теперь подключаемся к только что созданной базе
+            return psycopg2.connect(
+                dbname=self.dbname,
+                user=self.user,
+                password=self.password,
+                host=self.host,
+                port=self.port
+            )
+
+    def _close(self, conn):
+        try: conn.close()
+        except: pass
+        self.stats["closed"] += 1
+
+    def _is_alive(self, conn, idle_since):
+        if conn.closed:
+            return False
+
+        # Проверяем соединение запросом, только если оно долго простаивало
+        if time.monotonic() - idle_since < self.health_check_interval:
+            return True
+
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT 1')
+            cursor.close()
+            conn.rollback()
+            return True
+        except Exception:
+            core.logger.db_service.warning("Соединение из пула не прошло проверку и будет пересоздано")
+            return False
+
+    def _prune_idle(self):
+        # Закрываем соединения, простаивающие дольше таймаута, оставляя не меньше min_size
+        now = time.monotonic()
+        expired = []
+        while self._idle and len(self._idle) + self._in_use > self.min_size:
+            conn, idle_since = self._idle[0]
+            if now - idle_since < self.idle_timeout:
+                break
+            expired.append(self._idle.pop(0)[0])
+        return expired
+
+    def getconn(self):
+        started = time.monotonic()
+        deadline = started + self.checkout_timeout
+        waited = False
+
+        while True:
+            conn = None
+            idle_since = None
+            reserve = False
+
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._after_fork()
+
+                if self._idle:
+                    # Берём последнее возвращённое соединение, оно с наибольшей вероятностью живое
+                    conn, idle_since = self._idle.pop()
+                    self._in_use += 1
+                elif self._in_use < self.max_size:
+                    self._in_use += 1
+                    reserve = True
+
+            if conn is not None:
+                if self._is_alive(conn, idle_since):
+                    break
+                self.stats["health_check_failures"] += 1
+                self._close(conn)
+                reserve = True
+
+            if reserve:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._lock:
+                        self._in_use -= 1
+                    raise
+                self.stats["created"] += 1
+                break
+
+            if time.monotonic() >= deadline:
+                self.stats["timeouts"] += 1
+                raise psycopg2.pool.PoolError(
+                    f"Не удалось получить соединение из пула за ({self.checkout_timeout}) секунд")
+
+            waited = True
+            cooperative_sleep(0.05)
+
+        with self._lock:
+            self.stats["checkouts"] += 1
+            self.stats["max_in_use"] = max(self.stats["max_in_use"], self._in_use)
+            if waited:
+                self.stats["waits"] += 1
+                self.stats["wait_time_ms"] += (time.monotonic() - started) * 1000
+        return conn
+
+    def putconn(self, conn):
+        if conn is None:
+            return
+
+        reusable = not conn.closed
+        if reusable and conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            # Незавершённую транзакцию откатываем, битое соединение в пул не возвращаем
+            try: conn.rollback()
+            except Exception: reusable = False
+
+        with self._lock:
+            if self._pid != os.getpid():
+                # Соединение открыто в другом процессе, в этом процессе им не пользуемся
+                self._inherited.append(conn)
+                return
+
+            self._in_use = max(self._in_use - 1, 0)
+            if reusable:
+                self._idle.append((conn, time.monotonic()))
+            expired = self._prune_idle()
+
+        if not reusable:
+            self._close(conn)
+        for idle_conn in expired:
+            self._close(idle_conn)
+
+    def acquire_stream(self):
+        # Место для потокового ответа; соединение для него затем берётся из пула обычным getconn
+        deadline = time.monotonic() + self.checkout_timeout
+        waited = False
+
+        while True:
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._after_fork()
+
+                if self._streams < self.stream_max_size:
+                    self._streams += 1
+                    if waited:
+                        self.stats["stream_waits"] += 1
+                    return
+
+            if time.monotonic() >= deadline:
+                self.stats["stream_timeouts"] += 1
+                raise psycopg2.pool.PoolError(
+                    f"Все ({self.stream_max_size}) соединения для потоковых ответов заняты дольше "
+                    f"({self.checkout_timeout}) секунд")
+
+            waited = True
+            cooperative_sleep(0.05)
+
+    def release_stream(self):
+        with self._lock:
+            self._streams = max(self._streams - 1, 0)
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats.update({
+                "pid": self._pid,
+                "min_size": self.min_size,
+                "max_size": self.max_size,
+                "size": len(self._idle) + self._in_use,
+                "idle": len(self._idle),
+                "in_use": self._in_use,
+                "stream_max_size": self.stream_max_size,
+                "streams": self._streams
+            })
+        stats["wait_time_ms"] = round(stats["wait_time_ms"], 1)
+        return stats
+
+
+db_pool = ConnectionPool()
@@ -8,10 +8,9 @@ import threading
 
 config = core.configs.read_config_ini(about.config_path)
 
-db_context_manager = core.dbmanagement.DatabaseContextManager()
+# Контекстные менеджеры БД и FTP хранят соединение в самом экземпляре, поэтому для каждого вызова
+# создаётся новый: общий экземпляр одновременные запросы веб-сервера перезаписывали бы друг другу
 db_update = core.dbmanagement.DbUpdate()
-
-ftp_context_manager = core.connectors.FtpContextManager()
 api_connector = core.connectors.ApiConnector()
 
 def messages_append(messages, message):
@@ -25,7 +24,7 @@ def messages_append(messages, message):
 def ftp_delete_json(json_name):
     messages = []
     try:
-        with ftp_context_manager as ftp:
+        with core.connectors.FtpContextManager() as ftp:
             # Проверяем наличие файла на сервере
             files = ftp.nlst()  # Получаем список файлов в текущей директории
             if f"{json_name}.json" in files:
@@ -43,7 +42,7 @@ def ftp_delete_json(json_name):
 def delete_record_by_serial_number(json_name):
     messages = []
     try:
-        with db_context_manager as db:
+        with core.dbmanagement.DatabaseContextManager() as db:
             # Выполнение запроса на удаление
             db.cursor.execute('DELETE FROM pos_fiscals WHERE "serialNumber" = %s', (json_name,))
 
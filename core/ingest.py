@@ -0,0 +1,512 @@
+import core.logger
+import core.sys_manager
+import core.dbmanagement
+import core.schema
+import core.connectors
+import multiprocessing
+import queue
+import threading
+import time
+import json
+import os
+from collections import OrderedDict, deque
+
+dbquerie = core.dbmanagement.DbQueries()
+
+
+def ingest_key(json_data):
+    # Ключ устройства в очереди: серийный номер для ККТ, идентификаторы TeamViewer и AnyDesk для станции
+    if isinstance(json_data, dict) and "serialNumber" in json_data:
+        return "fiscal", json_data["serialNumber"]
+    return "pos", f"TV{json_data.get('teamviewer_id')}_AD{json_data.get('anydesk_id')}.json"
+
+
+class IngestQueue:
+    # Ограниченная очередь JSON на запись в БД. Повторный отчёт устройства, которое уже ждёт в очереди,
+    # не занимает новое место, а заменяет ожидающий, если он не старее по v_time
+    def __init__(self, max_size=10000, rate_window=60):
+        self.max_size = max(max_size, 1)
+        self.rate_window = rate_window
+        self._condition = threading.Condition()
+        self._items = OrderedDict()  # {ключ устройства: JSON}
+        self._rate_buckets = deque()  # [(секунда, поставлено, выбрано)]
+        self._started = time.monotonic()
+        self.stats = {"enqueued": 0, "dequeued": 0, "coalesced": 0, "rejected": 0, "max_depth": 0}
+
+    def _count_rate(self, enqueued=0, dequeued=0):
+        second = int(time.monotonic())
+        if self._rate_buckets and self._rate_buckets[-1][0] == second:
+            _, previous_enqueued, previous_dequeued = self._rate_buckets[-1]
+            self._rate_buckets[-1] = (second, previous_enqueued + enqueued, previous_dequeued + dequeued)
+        else:
+            self._rate_buckets.append((second, enqueued, dequeued))
+        while self._rate_buckets[0][0] <= second - self.rate_window:
+            self._rate_buckets.popleft()
+
+    def put_many(self, items):
+        # Ставит записи в очередь целиком или, если для новых устройств не хватает места, не ставит ни одной
+        with self._condition:
+            new_keys = {ingest_key(json_data) for json_data in items} - self._items.keys()
+            if len(self._items) + len(new_keys) > self.max_size:
+                self.stats["rejected"] += len(items)
+                return False
+
+            for json_data in items:
+                key = ingest_key(json_data)
+                pending = self._items.get(key)
+                if pending is not None:
+                    self.stats["coalesced"] += 1
+                    if str(json_data.get("v_time") or '') < str(pending.get("v_time") or ''):
+                        continue
+                self._items[key] = json_data
+
+            self.stats["enqueued"] += len(items)
+            self.stats["max_depth"] = max(self.stats["max_depth"], len(self._items))
+            self._count_rate(enqueued=len(items))
+            self._condition.notify()
+            return True
+
+    def put(self, json_data):
+        return self.put_many([json_data])
+
+    def get_batch(self, max_items, latency):
+        # Ждёт первую запись, затем добирает пакет до max_items записей, но не дольше latency секунд
+        with self._condition:
+            while not self._items:
+                self._condition.wait()
+
+            deadline = time.monotonic() + latency
+            while len(self._items) < max_items:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0 or not self._condition.wait(timeout):
+                    break
+
+            batch = [self._items.popitem(last=False)[1] for _ in range(min(max_items, len(self._items)))]
+            self.stats["dequeued"] += len(batch)
+            self._count_rate(dequeued=len(batch))
+            return batch
+
+    def qsize(self):
+        with self._condition:
+            return len(self._items)
+
+    def get_stats(self):
+        with self._condition:
+            self._count_rate()
+            window = min(self.rate_window, max(time.monotonic() - self._started, 1))
+            stats = dict(self.stats)
+            stats["depth"] = len(self._items)
+            stats["max_size"] = self.max_size
+            stats["enqueue_per_sec"] = round(sum(bucket[1] for bucket in self._rate_buckets) / window, 1)
+            stats["dequeue_per_sec"] = round(sum(bucket[2] for bucket in self._rate_buckets) / window, 1)
+        return stats
+
+
+class DurableIngestQueue:
+    # Очередь в таблице ingest_queue: принятые JSON переживают перезапуск сервера, а разбирать очередь
+    # могут обработчики любого количества экземпляров getad-db, подключённых к одной БД
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stats = {"enqueued": 0, "dequeued": 0, "coalesced": 0}
+
+    def put_many(self, items):
+        # Повторы одного устройства внутри запроса схлопываем заранее: один INSERT не может дважды
+        # обновить одну и ту же строку
+        pending = OrderedDict()
+        for json_data in items:
+            key = ingest_key(json_data)
+            previous = pending.get(key)
+            if previous is None or str(json_data.get("v_time") or '') >= str(previous.get("v_time") or ''):
+                pending[key] = json_data
+
+        dbquerie.enqueue_ingest_items([
+            (f"{kind}:{value}", str(json_data.get("v_time") or ''), json.dumps(json_data, ensure_ascii=False))
+            for (kind, value), json_data in pending.items()])
+
+        with self._lock:
+            self.stats["enqueued"] += len(items)
+            self.stats["coalesced"] += len(items) - len(pending)
+        return True
+
+    def put(self, json_data):
+        return self.put_many([json_data])
+
+    def process_batch(self, max_items, prepare):
+        return dbquerie.process_ingest_batch(max_items, prepare)
+
+    def count_dequeued(self, count):
+        # Записи разбирают процессы-обработчики, количество выбранных записей они сообщают процессу веб-сервера
+        with self._lock:
+            self.stats["dequeued"] += count
+
+    def qsize(self):
+        return dbquerie.get_ingest_queue_state()[0]
+
+    def get_stats(self):
+        depth, oldest_age = dbquerie.get_ingest_queue_state()
+        with self._lock:
+            stats = dict(self.stats)
+        stats["durable"] = True
+        stats["depth"] = depth
+        stats["oldest_age_sec"] = oldest_age
+        return stats
+
+
+class IngestPipeline(core.sys_manager.ResourceManagement):
+    # JSON, принятые через API, веб-сервер только ставит в очередь. Записью в БД (и резервной копией на FTP)
+    # занимаются отдельные процессы-обработчики, поэтому долгая транзакция или повторы отправки на FTP
+    # не останавливают обработку HTTP-запросов
+    def __init__(self):
+        super().__init__()
+        try: self.ftp_backup = int(self.config.get("ftp-connect", "ftp_backup", fallback=0))
+        except: self.ftp_backup = 0
+
+        try: self.batch_size = int(self.config.get("ingest", "batch-size", fallback=500))
+        except: self.batch_size = 500
+
+        try: self.batch_latency_ms = int(self.config.get("ingest", "batch-latency-ms", fallback=200))
+        except: self.batch_latency_ms = 200
+
+        try: self.queue_max_size = int(self.config.get("ingest", "queue-max-size", fallback=10000))
+        except: self.queue_max_size = 10000
+
+        try: self.durable_queue = int(self.config.get("ingest", "durable-queue", fallback=0))
+        except: self.durable_queue = 0
+
+        try: self.queue_workers = int(self.config.get("ingest", "queue-workers", fallback=1))
+        except: self.queue_workers = 1
+
+        self.batch_size = max(self.batch_size, 1)
+        self.queue_workers = max(self.queue_workers, 1)
+
+        # Очередь общая для всех потребителей в процессе веб-сервера
+        if self.durable_queue == 1:
+            self.queue = DurableIngestQueue()
+        else:
+            self.queue = IngestQueue(self.queue_max_size)
+
+        self.started = False
+        self.parent_pid = None
+        # Обработчики запускаются через spawn: fork из потока процесса веб-сервера скопировал бы
+        # в дочерний процесс захваченные другими потоками блокировки
+        self.context = multiprocessing.get_context('spawn')
+        self.workers = []
+        self.worker_number = None
+        self.worker_reports = {}  # {номер обработчика: последние счётчики, которые ведёт сам обработчик}
+        self.report_interval = 5
+        self.batch_queue = None  # Пакеты из очереди в памяти для процесса-обработчика (в самом обработчике)
+        # Веб-сервер передаёт каждому обработчику пакеты через его собственную очередь и помнит пакеты, которые
+        # обработчик ещё не записал, чтобы после его аварийного завершения передать их заново
+        self.worker_batches = 2  # Сколько пакетов может ждать у одного обработчика
+        self.batch_queues = {}  # {номер обработчика: очередь пакетов}
+        self.in_flight = {}  # {номер обработчика: {номер пакета: (пакет, попытка)}}
+        self.dispatch_condition = threading.Condition()
+        self.next_batch_id = 0
+        self.result_queue = None  # Результаты обработки пакетов для статистики веб-сервера
+        self.uploader = None
+
+        self.stats_lock = threading.Lock()
+        self.stats = {
+            "batches": 0,
+            "items": 0,
+            "rows": 0,
+            "written": 0,
+            "unchanged": 0,
+            "stale": 0,
+            "fallbacks": 0,
+            "db_time_ms": 0.0,
+            "last_batch_size": 0,
+            "max_batch_size": 0,
+            "last_rows_per_sec": 0.0,
+            "worker_restarts": 0,
+            "requeued_batches": 0,
+            "requeued_items": 0,
+            "dropped_batches": 0,
+            "dropped_items": 0
+        }
+
+    def start(self):
+        # Запускается один раз в процессе веб-сервера
+        if self.started:
+            return
+        self.started = True
+        self.parent_pid = os.getpid()
+
+        self.result_queue = self.context.Queue()
+        self.workers = [self.start_worker(number) for number in range(self.queue_workers)]
+        if self.durable_queue != 1:
+            threading.Thread(target=self.dispatch_batches, daemon=True).start()
+        threading.Thread(target=self.collect_results, daemon=True).start()
+        core.logger.connectors.info(f"Запущено ({self.queue_workers}) процессов обработки очереди JSON")
+
+    def start_worker(self, number):
+        batch_queue = None
+        if self.durable_queue != 1:
+            # Новому процессу - новая очередь: процесс, завершившийся во время чтения, мог оставить старую
+            # в неисправном состоянии, а её пакеты и так передаются заново
+            batch_queue = self.context.Queue(maxsize=self.worker_batches)
+            with self.dispatch_condition:
+                self.batch_queues[number] = batch_queue
+                self.in_flight[number] = {}
+
+        worker = self.context.Process(
+            target=run_worker, args=(number, self.parent_pid, batch_queue, self.result_queue), daemon=True)
+        worker.start()
+        return worker
+
+    def dispatch_batches(self):
+        # Поток веб-сервера: передаёт пакеты из очереди в памяти наименее занятому процессу-обработчику.
+        # Пока все обработчики заняты, новые JSON копятся и схлопываются в IngestQueue
+        while True:
+            try:
+                batch = self.queue.get_batch(self.batch_size, self.batch_latency_ms / 1000)
+                with self.dispatch_condition:
+                    while True:
+                        number = min(self.in_flight, key=lambda worker: len(self.in_flight[worker]))
+                        if len(self.in_flight[number]) < self.worker_batches:
+                            break
+                        self.dispatch_condition.wait(1)
+
+                    self.next_batch_id += 1
+                    self.send_batch(number, self.next_batch_id, batch, 1)
+            except Exception as e:
+                core.logger.connectors.error(f"Ошибка при передаче пакета обработчикам: {str(e)}", exc_info=True)
+                time.sleep(1)
+
+    def send_batch(self, number, batch_id, batch, attempt):
+        # Вызывается под dispatch_condition
+        self.in_flight[number][batch_id] = (batch, attempt)
+        self.batch_queues[number].put((batch_id, batch))
+
+    def finish_in_flight(self, number, batch_id, failed):
+        with self.dispatch_condition:
+            entry = self.in_flight.get(number, {}).pop(batch_id, None)
+            self.dispatch_condition.notify()
+
+        if failed and entry is not None:
+            with self.stats_lock:
+                self.stats["dropped_batches"] += 1
+                self.stats["dropped_items"] += len(entry[0])
+
+    def collect_results(self):
+        # Поток веб-сервера: собирает статистику обработанных пакетов и перезапускает завершившиеся обработчики
+        last_check = time.monotonic()
+        while True:
+            # Обработчики присылают счётчики регулярно, поэтому живость проверяем по времени, а не по тишине в очереди
+            if time.monotonic() - last_check >= self.report_interval:
+                self.restart_dead_workers()
+                last_check = time.monotonic()
+
+            try:
+                result = self.result_queue.get(timeout=self.report_interval)
+            except queue.Empty:
+                continue
+
+            with self.stats_lock:
+                self.worker_reports[result["worker"]] = result["reports"]
+            if result.get("batch") is not None:
+                self.finish_in_flight(result["worker"], result["batch"], result.get("failed", False))
+            if "items" not in result:
+                continue
+
+            with self.stats_lock:
+                self.stats["batches"] += 1
+                self.stats["items"] += result["items"]
+                self.stats["rows"] += result["rows"]
+                for name in ("written", "unchanged", "stale"):
+                    self.stats[name] += result[name]
+                self.stats["fallbacks"] += 1 if result["fallback"] else 0
+                self.stats["db_time_ms"] += result["elapsed"] * 1000
+                self.stats["last_batch_size"] = result["items"]
+                self.stats["max_batch_size"] = max(self.stats["max_batch_size"], result["items"])
+                self.stats["last_rows_per_sec"] = round(result["rows"] / result["elapsed"], 1)
+
+            if self.durable_queue == 1:
+                self.queue.count_dequeued(result["items"])
+
+    def restart_dead_workers(self):
+        for number, worker in enumerate(self.workers):
+            if not worker.is_alive():
+                core.logger.connectors.warning(
+                    f"Процесс обработки очереди ({number}) завершился с кодом ({worker.exitcode}) и будет перезапущен")
+                with self.dispatch_condition:
+                    lost = self.in_flight.get(number, {})
+                    old_queue = self.batch_queues.get(number)
+                self.workers[number] = self.start_worker(number)
+                with self.stats_lock:
+                    self.stats["worker_restarts"] += 1
+
+                if old_queue is not None:
+                    # Непрочитанные пакеты старой очереди входят в lost, сама очередь больше не нужна
+                    old_queue.cancel_join_thread()
+                    old_queue.close()
+                self.requeue_lost_batches(number, lost)
+
+    def requeue_lost_batches(self, number, lost):
+        # Пакеты, которые завершившийся обработчик получил, но не записал, передаются новому процессу.
+        # Пакет, при обработке которого обработчик завершается повторно, отбрасывается, чтобы
+        # не перезапускать процессы по кругу. Пакет, записанный перед самым завершением, может
+        # записаться ещё раз: повторная запись тех же данных ничего не меняет
+        requeued = dropped = 0
+        with self.dispatch_condition:
+            for batch_id, (batch, attempt) in lost.items():
+                if attempt >= 2:
+                    dropped += 1
+                    with self.stats_lock:
+                        self.stats["dropped_batches"] += 1
+                        self.stats["dropped_items"] += len(batch)
+                    continue
+
+                self.send_batch(number, batch_id, batch, attempt + 1)
+                requeued += 1
+                with self.stats_lock:
+                    self.stats["requeued_batches"] += 1
+                    self.stats["requeued_items"] += len(batch)
+
+        if requeued or dropped:
+            core.logger.connectors.warning(
+                f"Пакеты завершившегося процесса обработки очереди ({number}): передано заново ({requeued}), "
+                f"отброшено после повторного сбоя ({dropped})")
+
+    def worker_main(self, number):
+        # Процесс-обработчик: записывает пакеты в БД, пока жив процесс веб-сервера
+        core.logger.connectors.info(f"Процесс обработки очереди ({number}) запущен, PID ({os.getpid()})")
+        self.worker_number = number
+        self.uploader = core.connectors.ApiConnector()
+        core.schema.schema_manager.bootstrap_until_ready()
+
+        last_report = 0
+        while os.getppid() == self.parent_pid:
+            # Имена серверов новых клиентов запрашиваются в фоне и после записи пакета, поэтому
+            # счётчики обработчика отправляются веб-серверу и без новых пакетов
+            if time.monotonic() - last_report >= self.report_interval:
+                self.result_queue.put({"worker": number, "reports": self.get_worker_reports()})
+                last_report = time.monotonic()
+
+            try:
+                if self.durable_queue == 1:
+                    # Пустую очередь в БД опрашиваем с интервалом batch_latency_ms
+                    if not self.process_durable_batch():
+                        time.sleep(self.batch_latency_ms / 1000)
+                else:
+                    try:
+                        batch_id, batch = self.batch_queue.get(timeout=1)
+                    except queue.Empty:
+                        continue
+
+                    try:
+                        self.save_batch(batch, batch_id)
+                    except Exception:
+                        # Пакет не записан: веб-сервер снимает его с обработчика и учитывает как отброшенный
+                        self.result_queue.put({"worker": number, "reports": self.get_worker_reports(),
+                                               "batch": batch_id, "failed": True})
+                        raise
+            except Exception as e:
+                core.logger.connectors.error(f"Ошибка в обработчике очереди: {str(e)}", exc_info=True)
+                time.sleep(1)  # Пауза после ошибки
+
+    def split_batch(self, batch):
+        fiscals = {}
+        not_fiscals = {}
+
+        for json_data in batch:
+            # Проверяем тип данных: фискальный или обычный
+            if isinstance(json_data, dict) and "serialNumber" in json_data:
+                serial_number = json_data["serialNumber"]
+                previous = fiscals.get(serial_number)
+                # Если в пакет попало несколько отчётов одного устройства, оставляем самый свежий
+                if previous is None or str(json_data.get("v_time") or '') >= str(previous.get("v_time") or ''):
+                    fiscals[serial_number] = json_data
+            else:
+                teamviever_id = json_data.get("teamviewer_id")
+                anydesk_id = json_data.get("anydesk_id")
+                not_fiscals[f"TV{teamviever_id}_AD{anydesk_id}.json"] = json_data
+
+        return fiscals, not_fiscals
+
+    def save_batch(self, batch, batch_id):
+        # Пакет из очереди в памяти
+        fiscals, not_fiscals = self.split_batch(batch)
+        started = time.monotonic()
+        result = dbquerie.save_batch(fiscals, not_fiscals)
+        self.finish_batch(batch, fiscals, not_fiscals, result, max(time.monotonic() - started, 0.000001), batch_id)
+
+    def process_durable_batch(self):
+        # Пакет из очереди в БД: выборка, запись и удаление из очереди идут одной транзакцией,
+        # отправка на FTP - только после её фиксации, чтобы не держать блокировки записей очереди
+        started = time.monotonic()
+        processed = self.queue.process_batch(self.batch_size, self.split_batch)
+        if processed is None:
+            return False
+
+        batch, fiscals, not_fiscals, result = processed
+        self.finish_batch(batch, fiscals, not_fiscals, result, max(time.monotonic() - started, 0.000001))
+        return True
+
+    def finish_batch(self, batch, fiscals, not_fiscals, result, elapsed, batch_id=None):
+        self.result_queue.put({
+            "worker": self.worker_number,
+            "reports": self.get_worker_reports(),
+            "batch": batch_id,
+            "items": len(batch),
+            "rows": len(fiscals) + len(not_fiscals),
+            "written": result["written"],
+            "unchanged": result["unchanged"],
+            "stale": result["stale"],
+            "fallback": result["fallback"],
+            "elapsed": elapsed
+        })
+
+        core.logger.connectors.info(
+            f"Обработан пакет JSON через API: ({len(batch)}) записей за ({round(elapsed * 1000)}) мс, "
+            f"записано ({result['written']}), без изменений ({result['unchanged']})")
+        core.logger.connectors.debug(f"Записи пакета: {list(fiscals.keys()) + list(not_fiscals.keys())}")
+
+        if self.ftp_backup == 1:
+            for serial_number, json_data in fiscals.items():
+                self.uploader.ftp_upload(json_data, f"{serial_number}.json")
+            for filename, json_data in not_fiscals.items():
+                self.uploader.ftp_upload(json_data, filename)
+
+    def get_worker_reports(self):
+        return {
+            "client_enrichment": core.dbmanagement.client_enrichment.get_stats(),
+            "rms_cache": core.connectors.IikoRms.cache.get_stats()
+        }
+
+    def sum_worker_reports(self, name, own_stats):
+        # Счётчики, которые ведёт каждый процесс-обработчик, складываются со счётчиками процесса веб-сервера
+        with self.stats_lock:
+            reports = [worker_reports[name] for worker_reports in self.worker_reports.values()]
+        stats = dict(own_stats)
+        for report in reports:
+            for key, value in report.items():
+                stats[key] = stats.get(key, 0) + value
+        return stats
+
+    def get_stats(self):
+        with self.stats_lock:
+            stats = dict(self.stats)
+        stats["db_time_ms"] = round(stats["db_time_ms"], 1)
+        stats["avg_batch_size"] = round(stats["items"] / stats["batches"], 1) if stats["batches"] else 0
+        stats["rows_per_sec"] = round(stats["rows"] / (stats["db_time_ms"] / 1000), 1) if stats["db_time_ms"] else 0
+        stats["queue_size"] = self.queue.qsize()
+        stats["queue"] = self.queue.get_stats()
+        stats["batch_size"] = self.batch_size
+        stats["batch_latency_ms"] = self.batch_latency_ms
+        stats["workers"] = len(self.workers)
+        stats["workers_alive"] = sum(1 for worker in self.workers if worker.is_alive())
+        with self.dispatch_condition:
+            stats["in_flight_batches"] = sum(len(batches) for batches in self.in_flight.values())
+        return stats
+
+
+ingest_pipeline = IngestPipeline()
+
+
+def run_worker(number, parent_pid, batch_queue, result_queue):
+    # Точка входа процесса-обработчика: модули в нём импортируются заново, очереди передаются из веб-сервера
+    ingest_pipeline.parent_pid = parent_pid
+    ingest_pipeline.batch_queue = batch_queue
+    ingest_pipeline.result_queue = result_queue
+    ingest_pipeline.worker_main(number)
@@ -0,0 +1,316 @@
+import core.dbmanagement
+import core.dbpool
+import core.logger
+
+
+class SchemaManager(core.dbmanagement.DatabaseContextManager):
+    # Ключ advisory-блокировки, под которой миграции применяются только одним процессом за раз
+    lock_id = 7351042
+
+    # Версионированные миграции: (версия, описание, список SQL-выражений или функций вида f(db))
+    migrations = [
+        (1, "Базовые таблицы", [
+            '''CREATE TABLE IF NOT EXISTS pos_fiscals (
+                "serialNumber" TEXT PRIMARY KEY
+            )''',
+            '''CREATE TABLE IF NOT EXISTS pos_not_fiscals (
+                "filename" TEXT PRIMARY KEY
+            )''',
+            '''CREATE TABLE IF NOT EXISTS clients (
+                "id" TEXT PRIMARY KEY,
+                "url_rms" TEXT,
+                "INN" TEXT,
+                "organizationName" TEXT,
+                "serverName" TEXT,
+                "version" TEXT,
+                "manual_edit" INTEGER DEFAULT 0,
+                "last_updated" TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )''',
+            '''CREATE TABLE IF NOT EXISTS fn_sale_task (
+                "serialNumber" TEXT PRIMARY KEY,
+                "fn_serial" TEXT
+            )''',
+            '''CREATE TABLE IF NOT EXISTS api_keys (
+                "api_key" TEXT PRIMARY KEY,
+                "name" TEXT,
+                "admin_tag" INTEGER,
+                "active" INTEGER
+            )''',
+            '''CREATE TABLE IF NOT EXISTS bitrix_employees (
+                "id" TEXT PRIMARY KEY,
+                "NAME" TEXT,
+                "LAST_NAME" TEXT,
+                "UF_DEPARTMENT" TEXT,
+                "responsible" INTEGER DEFAULT 0
+            )''',
+            '''CREATE TABLE IF NOT EXISTS bitrix_projects (
+                "id" TEXT PRIMARY KEY,
+                "NAME" TEXT,
+                "SUBJECT_NAME" TEXT,
+                "observers" INTEGER DEFAULT 0
+            )''',
+        ]),
+        (2, "Хэш содержимого записей ККТ и станций", [
+            'ALTER TABLE pos_fiscals ADD COLUMN IF NOT EXISTS "_content_hash" TEXT',
+            'ALTER TABLE pos_not_fiscals ADD COLUMN IF NOT EXISTS "_content_hash" TEXT',
+        ]),
+        (3, "Уникальный url_rms в таблице клиентов", [
+            # Дубликаты могли появиться при одновременном добавлении клиента из разных процессов,
+            # оставляем запись с ручной правкой, а из остальных самую свежую
+            '''DELETE FROM clients a USING clients b
+               WHERE a."url_rms" = b."url_rms"
+                 AND (COALESCE(a."manual_edit", 0), COALESCE(a."last_updated", 'epoch'), a."id")
+                   < (COALESCE(b."manual_edit", 0), COALESCE(b."last_updated", 'epoch'), b."id")''',
+            'CREATE UNIQUE INDEX IF NOT EXISTS clients_url_rms_key ON clients ("url_rms")',
+        ]),
+        (4, "Функция разбора времени и столбцы, используемые в запросах", [
+            # Строгий разбор времени в формате 'YYYY-MM-DD HH:MI:SS', как datetime.strptime на стороне сервера:
+            # строку в другом формате или с некорректной датой функция возвращает как NULL
+            '''CREATE OR REPLACE FUNCTION getad_parse_timestamp(value TEXT) RETURNS TIMESTAMP AS $$
+               BEGIN
+                   IF value !~ '^\\d{4}-\\d{1,2}-\\d{1,2} \\d{1,2}:\\d{1,2}:\\d{1,2}$' THEN
+                       RETURN NULL;
+                   END IF;
+                   RETURN value::TIMESTAMP;
+               EXCEPTION WHEN OTHERS THEN
+                   RETURN NULL;
+               END;
+               $$ LANGUAGE plpgsql IMMUTABLE STRICT''',
+            # Столбцы, к которым обращаются запросы сервера, должны существовать и в пустой базе
+            *[f'ALTER TABLE pos_fiscals ADD COLUMN IF NOT EXISTS "{column}" TEXT'
+              for column in ("INN", "organizationName", "RNM", "fn_serial", "dateTime_end",
+                             "current_time", "v_time", "url_rms", "address")],
+        ]),
+        (5, "Типизированные столбцы времени и индексы по ним", [
+            # Генерируемые столбцы PostgreSQL пересчитывает при каждой записи, а при добавлении
+            # заполняет и для уже существующих строк; нераспознанная дата даёт NULL
+            *[f'''ALTER TABLE pos_fiscals ADD COLUMN IF NOT EXISTS "_{column}_ts" TIMESTAMP
+                  GENERATED ALWAYS AS (getad_parse_timestamp("{column}")) STORED'''
+              for column in ("dateTime_end", "current_time", "v_time")],
+            *[f'CREATE INDEX IF NOT EXISTS pos_fiscals_{column.lower()}_ts_idx ON pos_fiscals ("_{column}_ts")'
+              for column in ("dateTime_end", "current_time", "v_time")],
+        ]),
+        (6, "Поисковый документ записей ККТ", [
+            'ALTER TABLE pos_fiscals ADD COLUMN IF NOT EXISTS "_search_doc" TEXT',
+            # Документ собирается из значений всех неслужебных столбцов в нижнем регистре, разделённых
+            # символом chr(31), чтобы подстрока поиска не захватывала соседние столбцы.
+            # Аргументы триггера - имена столбцов (в нижнем регистре), которые в документ не входят
+            '''CREATE OR REPLACE FUNCTION getad_search_doc() RETURNS TRIGGER AS $$
+               BEGIN
+                   NEW."_search_doc" := (
+                       SELECT lower(string_agg(item.value, chr(31) ORDER BY item.key))
+                       FROM jsonb_each_text(to_jsonb(NEW)) AS item
+                       WHERE left(item.key, 1) <> '_' AND item.value IS NOT NULL
+                         AND NOT lower(item.key) = ANY (COALESCE(TG_ARGV, ARRAY[]::TEXT[]))
+                   );
+                   RETURN NEW;
+               END;
+               $$ LANGUAGE plpgsql''',
+        ]),
+        (7, "Индексы для поиска по отдельным полям", [
+            'ALTER TABLE pos_fiscals ADD COLUMN IF NOT EXISTS "modelName" TEXT',
+            # Индексы по началу значения без учёта регистра для запросов вида inn:7701...
+            *[f'''CREATE INDEX IF NOT EXISTS pos_fiscals_{column.lower()}_prefix_idx
+                  ON pos_fiscals (lower("{column}") text_pattern_ops)'''
+              for column in ("serialNumber", "INN", "RNM", "fn_serial", "modelName", "url_rms")],
+        ]),
+        (8, "Индекс подсказок по имени сервера клиента", [
+            'CREATE INDEX IF NOT EXISTS clients_servername_prefix_idx ON clients (lower("serverName") text_pattern_ops)',
+        ]),
+        (9, "Журнал изменений записей ККТ и станций", [
+            '''CREATE TABLE IF NOT EXISTS change_tombstones (
+                "table_name" TEXT,
+                "record_key" TEXT,
+                "change_txid" XID8,
+                "deleted_at" TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY ("table_name", "record_key")
+            )''',
+            '''CREATE INDEX IF NOT EXISTS change_tombstones_txid_idx
+               ON change_tombstones ("change_txid", "table_name" COLLATE "C", "record_key" COLLATE "C")''',
+            # Новая запись и запись, содержимое которой изменилось, получают номер изменившей их транзакции.
+            # Номер не требует блокировок и не расходуется, если UPSERT ничего не изменил. Порядок фиксации
+            # номера не отражают, поэтому журнал (get_changes) отдаёт только изменения транзакций,
+            # которые старше всех ещё не завершённых
+            '''CREATE OR REPLACE FUNCTION getad_change_txid() RETURNS TRIGGER AS $$
+               BEGIN
+                   IF TG_OP = 'INSERT' OR NEW."_content_hash" IS DISTINCT FROM OLD."_content_hash" THEN
+                       NEW."_change_txid" := pg_current_xact_id();
+                   END IF;
+                   RETURN NEW;
+               END;
+               $$ LANGUAGE plpgsql''',
+            # Для удалённой записи остаётся отметка с номером удалившей транзакции, аргумент триггера - столбец ключа
+            '''CREATE OR REPLACE FUNCTION getad_change_tombstone() RETURNS TRIGGER AS $$
+               BEGIN
+                   INSERT INTO change_tombstones ("table_name", "record_key", "change_txid")
+                   VALUES (TG_TABLE_NAME, to_jsonb(OLD) ->> TG_ARGV[0], pg_current_xact_id())
+                   ON CONFLICT ("table_name", "record_key")
+                   DO UPDATE SET "change_txid" = EXCLUDED."change_txid", "deleted_at" = CURRENT_TIMESTAMP;
+                   RETURN OLD;
+               END;
+               $$ LANGUAGE plpgsql''',
+            # Запись, созданная заново, снимает отметку об удалении, поэтому запись и отметка не существуют
+            # одновременно. AFTER INSERT срабатывает только для действительно вставленных строк,
+            # UPSERT существующей записи его не вызывает
+            '''CREATE OR REPLACE FUNCTION getad_change_revive() RETURNS TRIGGER AS $$
+               BEGIN
+                   DELETE FROM change_tombstones
+                   WHERE "table_name" = TG_TABLE_NAME AND "record_key" = to_jsonb(NEW) ->> TG_ARGV[0];
+                   RETURN NULL;
+               END;
+               $$ LANGUAGE plpgsql''',
+            *[statement
+              for table_name, key_column in (("pos_fiscals", "serialNumber"), ("pos_not_fiscals", "filename"))
+              for statement in (
+                  # Существующие записи получают нулевой номер, журнал без курсора начинается с них
+                  f'''ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS "_change_txid" XID8 NOT NULL DEFAULT '0' ''',
+                  f'''CREATE INDEX IF NOT EXISTS {table_name}_change_txid_idx
+                      ON {table_name} ("_change_txid", "{key_column}" COLLATE "C")''',
+                  f'DROP TRIGGER IF EXISTS {table_name}_change_txid ON {table_name}',
+                  f'''CREATE TRIGGER {table_name}_change_txid BEFORE INSERT OR UPDATE ON {table_name}
+                      FOR EACH ROW EXECUTE FUNCTION getad_change_txid()''',
+                  f'DROP TRIGGER IF EXISTS {table_name}_change_tombstone ON {table_name}',
+                  f'''CREATE TRIGGER {table_name}_change_tombstone AFTER DELETE ON {table_name}
+                      FOR EACH ROW EXECUTE FUNCTION getad_change_tombstone('{key_column}')''',
+                  f'DROP TRIGGER IF EXISTS {table_name}_change_revive ON {table_name}',
+                  f'''CREATE TRIGGER {table_name}_change_revive AFTER INSERT ON {table_name}
+                      FOR EACH ROW EXECUTE FUNCTION getad_change_revive('{key_column}')''',
+              )],
+        ]),
+        (10, "Очередь JSON на запись в БД", [
+            '''CREATE TABLE IF NOT EXISTS ingest_queue (
+                "id" BIGSERIAL PRIMARY KEY,
+                "item_key" TEXT UNIQUE,
+                "v_time" TEXT,
+                "payload" TEXT,
+                "enqueued_at" TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )''',
+        ]),
+        # Выражение индекса совпадает с ключом сортировки страницы списка ККТ (get_fiscals_page),
+        # поэтому страница по этим столбцам читается по индексу, а не сортировкой всей выборки
+        (11, "Индексы сортировки списка ККТ", [
+            f'''CREATE INDEX IF NOT EXISTS pos_fiscals_{column.lower()}_sort_idx
+                ON pos_fiscals (lower(COALESCE("{column}", 'None')), "serialNumber")'''
+            for column in ("serialNumber", "organizationName", "INN", "dateTime_end", "v_time")
+        ]),
+        # Отметки об удалении старше срока хранения удаляются (DbQueries.clean_change_tombstones), наибольший
+        # номер транзакции среди удалённых отметок хранится в change_feed_state: курсор журнала изменений
+        # с номером не больше него мог пропустить удаления, и клиенту нужно синхронизироваться заново
+        (12, "Срок хранения отметок об удалении", [
+            'CREATE INDEX IF NOT EXISTS change_tombstones_deleted_at_idx ON change_tombstones ("deleted_at")',
+            '''CREATE TABLE IF NOT EXISTS change_feed_state (
+                "id" INTEGER PRIMARY KEY CHECK ("id" = 1),
+                "purged_txid" XID8 NOT NULL DEFAULT '0'
+            )''',
+            'INSERT INTO change_feed_state ("id") VALUES (1) ON CONFLICT DO NOTHING',
+        ]),
+    ]
+
+    def __init__(self):
+        super().__init__()
+        self.ready = False
+
+    def get_applied_versions(self):
+        with core.dbmanagement.DatabaseContextManager() as db:
+            db.cursor.execute('SELECT pg_advisory_xact_lock(%s)', (self.lock_id,))
+            db.cursor.execute('''
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    "version" INTEGER PRIMARY KEY,
+                    "description" TEXT,
+                    "applied_at" TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            db.cursor.execute('SELECT "version" FROM schema_version')
+            return {row[0] for row in db.cursor.fetchall()}
+
+    def apply_migration(self, version, description, statements):
+        with core.dbmanagement.DatabaseContextManager() as db:
+            db.cursor.execute('SELECT pg_advisory_xact_lock(%s)', (self.lock_id,))
+
+            # Миграцию мог применить другой процесс, пока мы ждали блокировку
+            db.cursor.execute('SELECT 1 FROM schema_version WHERE "version" = %s', (version,))
+            if db.cursor.fetchone():
+                return
+
+            for statement in statements:
+                if callable(statement):
+                    statement(db)
+                else:
+                    db.cursor.execute(statement)
+
+            db.cursor.execute(
+                'INSERT INTO schema_version ("version", "description") VALUES (%s, %s)', (version, description))
+            core.logger.db_service.info(f"Применена миграция схемы БД ({version}): {description}")
+
+    def bootstrap(self):
+        try:
+            applied = self.get_applied_versions()
+
+            for version, description, statements in self.migrations:
+                if version not in applied:
+                    self.apply_migration(version, description, statements)
+
+            self.sync_search_document()
+
+            self.ready = True
+            core.logger.db_service.info(
+                f"Схема БД актуальна, версия ({max(version for version, _, _ in self.migrations)})")
+            return True
+        except Exception:
+            core.logger.db_service.error("Не удалось подготовить схему БД", exc_info=True)
+            return False
+
+    def sync_search_document(self):
+        # Триггер поискового документа пересоздаётся, если изменился список исключённых столбцов,
+        # после чего документы всех записей пересобираются
+        excluded = sorted({column.strip().lower() for column in self.config.get(
+            "webserver", "search-exclude-columns", fallback="licenses").split(',') if column.strip()})
+
+        with core.dbmanagement.DatabaseContextManager() as db:
+            db.cursor.execute('SELECT pg_advisory_xact_lock(%s)', (self.lock_id,))
+            db.cursor.execute('''
+                SELECT tgargs FROM pg_trigger
+                WHERE tgname = 'pos_fiscals_search_doc' AND tgrelid = 'pos_fiscals'::regclass
+            ''')
+            row = db.cursor.fetchone()
+            current = bytes(row[0]).decode().split('\x00')[:-1] if row else None
+
+            if current != excluded:
+                arguments = ', '.join(db.cursor.mogrify('%s', (column,)).decode() for column in excluded)
+                db.cursor.execute('DROP TRIGGER IF EXISTS pos_fiscals_search_doc ON pos_fiscals')
+                db.cursor.execute(f'''
+                    CREATE TRIGGER pos_fiscals_search_doc BEFORE INSERT OR UPDATE ON pos_fiscals
+                    FOR EACH ROW EXECUTE FUNCTION getad_search_doc({arguments})
+                ''')
+                db.cursor.execute('UPDATE pos_fiscals SET "_search_doc" = NULL')
+                core.logger.db_service.info(
+                    f"Поисковый документ пересобран для ({db.cursor.rowcount}) записей, исключены столбцы: {excluded}")
+
+            db.cursor.execute("SELECT 1 FROM pg_indexes WHERE indexname = 'pos_fiscals_search_doc_trgm_idx'")
+            if db.cursor.fetchone():
+                return
+
+            # Триграммный индекс ускоряет поиск подстроки, но расширение pg_trgm может быть недоступно:
+            # тогда поиск работает без индекса, по одному столбцу вместо всех
+            db.cursor.execute('SAVEPOINT search_trgm')
+            try:
+                db.cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+                db.cursor.execute('''CREATE INDEX IF NOT EXISTS pos_fiscals_search_doc_trgm_idx
+                                     ON pos_fiscals USING GIN ("_search_doc" gin_trgm_ops)''')
+                db.cursor.execute('RELEASE SAVEPOINT search_trgm')
+                core.logger.db_service.info("Создан триграммный индекс поискового документа")
+            except Exception as e:
+                db.cursor.execute('ROLLBACK TO SAVEPOINT search_trgm')
+                core.logger.db_service.warning(
+                    f"Расширение pg_trgm недоступно, поиск будет выполняться без индекса: {str(e).splitlines()[0]}")
+
+    def bootstrap_until_ready(self, retry_period=30):
+        # Пока БД недоступна (например, не настроено подключение), повторяем попытки,
+        # не блокируя остальную работу сервера
+        while not self.bootstrap():
+            core.logger.db_service.info(
+                f"Следующая попытка подготовить схему БД через ({retry_period}) секунд")
+            core.dbpool.cooperative_sleep(retry_period)
+
+
+schema_manager = SchemaManager()
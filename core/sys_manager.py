@@ -3,6 +3,9 @@ import core.logger
 import os
 import json
 import calendar
+import threading
+import time
+from collections import OrderedDict
 from datetime import date, datetime, timedelta
 
 class ResourceManagement:
@@ -69,3 +72,43 @@ class ResourceManagement:
         except Exception:
             core.logger.web_server.error(f"Не удалось вычислить разницу между текущей датой и {date_string}",
                                          exc_info=True)
+
+
+class TtlCache:
+    # Потокобезопасный кэш с временем жизни записей, при переполнении вытесняются давно не использованные
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._items = OrderedDict()  # {ключ: (время истечения, значение)}
+        self.stats = {"hits": 0, "misses": 0, "expired": 0, "evicted": 0}
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None:
+                if item[0] > time.monotonic():
+                    self._items.move_to_end(key)
+                    self.stats["hits"] += 1
+                    return item[1]
+                del self._items[key]
+                self.stats["expired"] += 1
+            self.stats["misses"] += 1
+            return default
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._items[key] = (time.monotonic() + ttl, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+                self.stats["evicted"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats["size"] = len(self._items)
+        return stats
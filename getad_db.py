@@ -2,12 +2,16 @@ import core.logger
 import core.configs
 import core.sys_manager
 import core.connectors
+import core.ingest
 import integrations.bitrix24
 import about
 import os, json
+import csv, io
 import time
 import core.dbmanagement
-from flask import Flask, render_template, request, jsonify
+import core.dbpool
+import core.schema
+from flask import Flask, render_template, request, jsonify, Response, stream_with_context
 import multiprocessing
 import eventlet
 from eventlet import wsgi
@@ -36,11 +40,22 @@ class WebServerSetup(core.sys_manager.ResourceManagement):
         except Exception:
             self.port = 30005
 
+        try: self.green_db = int(self.config.get("webserver", "green-db", fallback=1))
+        except: self.green_db = 1
+
+        try: self.socket_timeout = int(self.config.get("webserver", "socket-timeout-sec", fallback=60))
+        except: self.socket_timeout = 60
+
         self.server_process = None
         self.bitrix24_thread = None
 
     def webserver(self):
-        eventlet.wsgi.server(eventlet.listen(('0.0.0.0', self.port)), self.app, debug=False)
+        # Запросы к БД из обработчиков веб-сервера уступают управление другим запросам, пока ждут ответа
+        if self.green_db == 1 and core.dbpool.enable_green_db():
+            core.logger.web_server.info("Запросы веб-сервера к БД выполняются в green-режиме")
+        # Клиент, который перестал читать ответ, отключается по таймауту и освобождает соединение потокового ответа
+        eventlet.wsgi.server(eventlet.listen(('0.0.0.0', self.port)), self.app, debug=False,
+                             socket_timeout=self.socket_timeout)
 
     def crash_server(self):
         time.sleep(5)
@@ -52,9 +67,14 @@ class WebServerSetup(core.sys_manager.ResourceManagement):
         os._exit(1)
 
     def subprocess_run(self):
+        # Схема БД готовится один раз при старте, а не в каждом запросе
+        core.schema.schema_manager.bootstrap_until_ready()
+
         self.bitrix24_thread = threading.Thread(target=bitrix24.task_manager, daemon=False)
         self.bitrix24_thread.start()
 
+        threading.Thread(target=db_update.clean_change_tombstones_on_schedule, daemon=True).start()
+
         db_update.pos_tables_update()
 
     # Функция для проверки аутентификации
@@ -105,12 +125,20 @@ class WebServerRoute(WebServerSetup):
                                'licenses', 'url_rms', 'teamviewer_id', 'anydesk_id', 'litemanager_id']
     def __init__(self):
         super().__init__()
+        try: self.fiscals_page_size = int(self.config.get("webserver", "fiscals-page-size", fallback=200))
+        except: self.fiscals_page_size = 200
+
+        self.fiscals_page_size = min(max(self.fiscals_page_size, 1), 1000)
         self.register_routes()
 
     def register_routes(self):
         # Регистрация всех маршрутов
         self.app.add_url_rule('/', 'index', self.requires_auth(self.index), methods=['GET'])
         self.app.add_url_rule('/fiscals', 'fiscals', self.requires_auth(self.fiscals), methods=['GET'])
+        self.app.add_url_rule('/fiscals/data', 'fiscals_data', self.requires_auth(self.fiscals_data), methods=['GET'])
+        self.app.add_url_rule('/fiscals/export', 'fiscals_export', self.requires_auth(self.fiscals_export),
+                              methods=['POST'])
+        self.app.add_url_rule('/api/suggest', 'suggest', self.requires_auth(self.suggest), methods=['GET'])
         self.app.add_url_rule('/onlypos', 'pos', self.requires_auth(self.pos), methods=['GET'])
         self.app.add_url_rule('/search', 'search', self.requires_auth(self.search), methods=['GET', 'POST'])
         self.app.add_url_rule('/dont-update', 'dont_update', self.requires_auth(self.dont_update),
@@ -144,6 +172,9 @@ class WebServerRoute(WebServerSetup):
         self.app.add_url_rule(
             '/api/submit_json', 'submit_json', api_connector.requires_admin_api_key(api_method.submit_json),
             methods=['POST'])
+        self.app.add_url_rule(
+            '/api/submit_batch', 'submit_batch', api_connector.requires_admin_api_key(api_method.submit_batch),
+            methods=['POST'])
         self.app.add_url_rule('/api/get_serial_numbers', 'get_serial_numbers',
                               api_connector.requires_api_key(api_method.get_serial_numbers),
                               methods=['GET'])
@@ -153,22 +184,112 @@ class WebServerRoute(WebServerSetup):
         self.app.add_url_rule('/api/get_pos_data', 'get_pos_data',
                               api_connector.requires_api_key(api_method.get_pos_data),
                               methods=['GET'])
+        self.app.add_url_rule('/api/changes', 'changes',
+                              api_connector.requires_api_key(api_method.get_changes),
+                              methods=['GET'])
+        self.app.add_url_rule('/api/get_stats', 'get_stats',
+                              api_connector.requires_admin_api_key(api_method.get_stats),
+                              methods=['GET'])
+
+    def stream_page(self, template_name, **context):
+        # Страница отдаётся по частям по мере чтения строк из БД. Фрагменты шаблона собираются в буфер,
+        # чтобы не отправлять в сокет каждую ячейку таблицы отдельно
+        self.app.update_template_context(context)
+        stream = self.app.jinja_env.get_template(template_name).stream(**context)
+        stream.enable_buffering(500)
+        return Response(stream_with_context(stream), mimetype='text/html')
 
     def index(self):
         return render_template('index.html')
 
     def fiscals(self):
-        data, columns = db_queries.get_data_pos_fiscals()
+        # Строки таблицы страница загружает отдельными запросами к '/fiscals/data'
+        columns = db_queries.get_fiscals_columns()
 
         return render_template('fiscals.html',
-                               data=data,
                                columns=columns,
-                               default_visible_columns=self.default_visible_columns,
-                               enumerate=enumerate)
+                               page_size=self.fiscals_page_size,
+                               default_visible_columns=self.default_visible_columns)
+
+    def fiscals_data(self):
+        try:
+            sort_column = request.args.get('sort', 'serialNumber')
+            descending = request.args.get('order') == 'desc'
+            cursor = request.args.get('cursor') or None
+
+            try: limit = min(max(int(request.args.get('limit', self.fiscals_page_size)), 1), 1000)
+            except ValueError: limit = self.fiscals_page_size
+
+            try:
+                filters = json.loads(request.args.get('filters', '[]'))
+                if not isinstance(filters, list) or not all(isinstance(item, dict) for item in filters):
+                    raise ValueError
+            except ValueError:
+                return jsonify({'status': 'error', 'message': 'Invalid filters'}), 400
+
+            try:
+                page = db_queries.get_fiscals_page(sort_column, descending, filters, cursor, limit)
+            except ValueError as e:
+                return jsonify({'status': 'error', 'message': str(e)}), 400
+
+            return jsonify(page)
+        except Exception as e:
+            core.logger.web_server.error("Не удалось получить страницу списка ФР", exc_info=True)
+            return jsonify({'status': 'error', 'message': str(e)}), 500
+
+    def csv_rows(self, header, rows, batch_rows=500):
+        # CSV для Excel: разделитель ';' и BOM в начале, строки отправляются пачками по мере чтения из БД
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, delimiter=';', lineterminator='\r\n')
+        buffer.write('\ufeff')
+        writer.writerow(header)
+
+        for index, row in enumerate(rows, 1):
+            writer.writerow(['' if value is None else value for value in row])
+            if index % batch_rows == 0:
+                yield buffer.getvalue().encode('utf-8')
+                buffer.seek(0)
+                buffer.truncate()
+
+        yield buffer.getvalue().encode('utf-8')
+
+    def fiscals_export(self):
+        try:
+            try:
+                export_columns = json.loads(request.form.get('columns') or '[]')
+                filters = json.loads(request.form.get('filters') or '[]')
+                serials = json.loads(request.form['serials']) if request.form.get('serials') else None
+
+                if not isinstance(export_columns, list) or not isinstance(filters, list) \
+                        or not all(isinstance(item, dict) for item in filters) \
+                        or (serials is not None and not isinstance(serials, list)):
+                    raise ValueError
+            except ValueError:
+                return jsonify({'status': 'error', 'message': 'Invalid export parameters'}), 400
+
+            header, rows = db_queries.export_fiscals(
+                export_columns, filters, serials,
+                request.form.get('sort', 'serialNumber'), request.form.get('order') == 'desc')
+
+            core.logger.web_server.info(
+                f"Выгрузка ФР в CSV: столбцов ({len(header)}), "
+                f"{'по списку из (' + str(len(serials)) + ') серийных номеров' if serials is not None else 'по фильтрам'}")
+            return Response(stream_with_context(self.csv_rows(header, rows)), mimetype='text/csv',
+                            headers={'Content-Disposition': 'attachment; filename=selected_data.csv'})
+        except Exception as e:
+            core.logger.web_server.error("Не удалось выгрузить список ФР в CSV", exc_info=True)
+            return jsonify({'status': 'error', 'message': str(e)}), 500
+
+    def suggest(self):
+        try:
+            return jsonify({'suggestions': db_queries.get_suggestions(request.args.get('q', ''))})
+        except Exception as e:
+            core.logger.web_server.error("Не удалось получить подсказки для строки поиска", exc_info=True)
+            return jsonify({'status': 'error', 'message': str(e)}), 500
 
     def pos(self):
         data, columns = db_queries.get_only_pos()
-        return render_template('pos.html', data=data, columns=columns)
+        return self.stream_page('pos.html', data=data, columns=columns)
 
     def search(self):
         try:
@@ -177,7 +298,7 @@ class WebServerRoute(WebServerSetup):
 
             modified_data, columns = db_queries.search_querie(search_query)
 
-            return render_template('search.html', search_query=search_query,
+            return self.stream_page('search.html', search_query=search_query,
                                    search_results=modified_data, columns=columns,
                                    default_visible_columns=self.default_visible_columns, enumerate=enumerate)
         except Exception:
@@ -191,7 +312,7 @@ class WebServerRoute(WebServerSetup):
         field = "current_time"
         modified_data, columns = db_queries.search_dont_update(field, days)
 
-        return render_template('search.html', search_query=search_query,
+        return self.stream_page('search.html', search_query=search_query,
                                search_results=modified_data, columns=columns,
                                default_visible_columns=self.default_visible_columns, enumerate=enumerate)
 
@@ -203,7 +324,7 @@ class WebServerRoute(WebServerSetup):
         field = "v_time"
         modified_data, columns = db_queries.search_dont_update(field, days)
 
-        return render_template('search.html', search_query=search_query,
+        return self.stream_page('search.html', search_query=search_query,
                                search_results=modified_data, columns=columns,
                                default_visible_columns=self.default_visible_columns, enumerate=enumerate)
 
@@ -522,5 +643,20 @@ if __name__ == "__main__":
     server_process.daemon = True
     server_process.start()
 
-    api_connector.update_api_keys()
+    # Обработчики очереди JSON запускаются отдельными процессами, веб-сервер только принимает запросы
+    core.ingest.ingest_pipeline.start()
+
+    def prepare_database():
+        core.schema.schema_manager.bootstrap_until_ready()
+        api_connector.update_api_keys()
+
+    # Запросы начинаем принимать после подготовки схемы БД, чтобы они не обращались к ещё не созданным
+    # таблицам. Если БД недоступна (например, подключение ещё не настроено), сервер всё равно запускается,
+    # чтобы подключение можно было указать на странице настроек; схема и ключи подготовятся в фоне
+    schema_thread = threading.Thread(target=prepare_database, daemon=True)
+    schema_thread.start()
+    schema_thread.join(timeout=60)
+    if not core.schema.schema_manager.ready:
+        core.logger.web_server.warning("Схема БД пока не подготовлена, веб-сервер запускается без неё")
+
     webserver.webserver()
@@ -1,40 +1,156 @@
-// Объект для хранения текущего направления сортировки каждого столбца
-const sortDirections = {};
+// Текущая сортировка: столбец и направление (true = по возрастанию, false = по убыванию)
+const sortState = { column: 'serialNumber', ascending: true };
+
+// Состояние постраничной загрузки строк с сервера
+let nextCursor = null;
+let totalRows = 0;
+let isLoading = false;
+let requestId = 0;
 
 function sortTable(columnIndex) {
-	var table = document.getElementById("data-table");
-	var tbody = table.tBodies[0];
-	var rows = Array.from(tbody.rows);
-	
-	// Получаем или устанавливаем направление сортировки для этого столбца
-	// true = по возрастанию, false = по убыванию
-	sortDirections[columnIndex] = !sortDirections[columnIndex];
-	const isAscending = sortDirections[columnIndex];
-	
-	// Сортировка массива строк
-	rows.sort(function(a, b) {
-		var aValue = a.getElementsByTagName("td")[columnIndex].innerHTML.toLowerCase();
-		var bValue = b.getElementsByTagName("td")[columnIndex].innerHTML.toLowerCase();
-		
-		if (isAscending) {
-			return aValue > bValue ? 1 : -1;
-		} else {
-			return aValue < bValue ? 1 : -1;
-		}
+	const column = tableColumns[columnIndex - 1];
+
+	// Повторный клик по тому же столбцу меняет направление сортировки
+	if (sortState.column === column) {
+		sortState.ascending = !sortState.ascending;
+	} else {
+		sortState.column = column;
+		sortState.ascending = true;
+	}
+
+	reloadTable();
+}
+
+// Сбрасывает загруженные строки и запрашивает первую страницу с текущими сортировкой и фильтрами
+function reloadTable() {
+	const tbody = document.getElementById("data-table").tBodies[0];
+	tbody.innerHTML = '';
+	nextCursor = null;
+	loadPage(true);
+}
+
+function loadPage(reset) {
+	if (isLoading && !reset) return;
+	if (!reset && !nextCursor) return;
+
+	const filters = currentFilters();
+
+	const params = new URLSearchParams({
+		sort: sortState.column,
+		order: sortState.ascending ? 'asc' : 'desc',
+		limit: pageSize,
+		filters: JSON.stringify(filters)
 	});
-	
-	// Перемещение строк в таблице в соответствии с отсортированным массивом
+	if (!reset) {
+		params.set('cursor', nextCursor);
+	}
+
+	// Ответы на устаревшие запросы (до смены сортировки или фильтров) отбрасываем
+	const currentRequest = ++requestId;
+	isLoading = true;
+	setLoadStatus('Загрузка...');
+
+	fetch(dataUrl + '?' + params.toString(), { credentials: 'same-origin' })
+		.then(response => response.json().then(data => {
+			if (!response.ok) throw new Error(data.message || response.statusText);
+			return data;
+		}))
+		.then(data => {
+			if (currentRequest !== requestId) return;
+			if (data.total !== null) totalRows = data.total;
+			nextCursor = data.next_cursor;
+			renderRows(data.columns, data.rows);
+			isLoading = false;
+			setLoadStatus(nextCursor ? '' : 'Все записи загружены');
+			updateRowCounter();
+			// Если страница не заполнила экран, сразу подгружаем следующую
+			loadMoreIfNeeded();
+		})
+		.catch(error => {
+			if (currentRequest !== requestId) return;
+			isLoading = false;
+			console.error('Ошибка при загрузке данных:', error);
+			setLoadStatus('Не удалось загрузить данные: ' + error.message);
+		});
+}
+
+function currentFilters() {
+	return Object.keys(activeFilters).map(columnIndex => ({
+		column: tableColumns[parseInt(columnIndex) - 1],
+		type: activeFilters[columnIndex].type,
+		text: activeFilters[columnIndex].text
+	}));
+}
+
+function renderRows(columns, rows) {
+	const table = document.getElementById("data-table");
+	const tbody = table.tBodies[0];
+	const headers = table.tHead.rows[0].cells;
+
+	// Значения в ответе сервера сопоставляем со столбцами таблицы по имени
+	const positions = {};
+	columns.forEach((column, index) => positions[column] = index);
+
+	const fragment = document.createDocumentFragment();
 	rows.forEach(function(row) {
-		tbody.appendChild(row);
+		const tr = document.createElement('tr');
+		if (row[row.length - 1]) {
+			tr.className = 'expired-row'; // последний элемент строки - признак устаревания
+		}
+
+		const checkboxCell = document.createElement('td');
+		const checkbox = document.createElement('input');
+		checkbox.type = 'checkbox';
+		checkboxCell.appendChild(checkbox);
+		tr.appendChild(checkboxCell);
+
+		tableColumns.forEach(function(column, index) {
+			const td = document.createElement('td');
+			const value = column in positions ? row[positions[column]] : null;
+
+			if (column === 'licenses') {
+				if (value) {
+					const link = document.createElement('a');
+					link.href = '#';
+					link.textContent = 'Скачать';
+					link.addEventListener('click', function(e) {
+						e.preventDefault();
+						downloadTXT(value, 'license.json');
+					});
+					td.appendChild(link);
+					addLicenseIndicator(td, value);
+				}
+			} else {
+				td.textContent = value === null ? 'None' : value;
+			}
+
+			// Видимость столбца берём из заголовка
+			td.classList.toggle('hidden-column', headers[index + 1].classList.contains('hidden-column'));
+			tr.appendChild(td);
+		});
+
+		fragment.appendChild(tr);
 	});
-	
-	updateRowCounter(); // Обновляем счётчик строк после сортировки
+	tbody.appendChild(fragment);
+}
+
+function setLoadStatus(text) {
+	document.getElementById("load-status").innerText = text;
 }
 
+function loadMoreIfNeeded() {
+	if (nextCursor && !isLoading &&
+		window.innerHeight + window.scrollY >= document.documentElement.scrollHeight - 500) {
+		loadPage(false);
+	}
+}
+
+window.addEventListener("scroll", loadMoreIfNeeded);
+
 function updateRowCounter() {
 	var table = document.getElementById("data-table");
-	var rowCount = table.rows.length - 1; // Учитываем только строки данных, исключая заголовок
-	document.getElementById("row-counter").innerText = " " + rowCount;
+	var loadedRows = table.tBodies[0].rows.length;
+	document.getElementById("row-counter").innerText = " " + loadedRows + " / " + totalRows;
 }
 
 function setColumnClickHandlers() {
@@ -64,47 +180,62 @@ function downloadTXT(data, filename) {
 	URL.revokeObjectURL(url);
 }
 
-// Функция для генерации и загрузки CSV-файла
-function downloadCSV() {
+// Выгрузка CSV формируется на сервере: выбранные строки передаются списком серийных номеров,
+// а при выгрузке всех записей - текущими фильтрами и сортировкой таблицы
+function downloadCSV(allRows) {
 	var table = document.getElementById("data-table");
-	var rows = table.rows;
-	var csvContent = "data:text/csv;charset=utf-8,";
-
-	// Получаем только видимые заголовки (начиная с индекса 1, чтобы пропустить столбец с чекбоксами)
-	var headers = [];
-	var visibleColumnIndexes = []; // Сохраняем индексы видимых столбцов
-	for (var j = 1; j < rows[0].cells.length; j++) {
-		var cell = rows[0].cells[j];
-		if (!cell.classList.contains('hidden-column')) {
-			// Извлекаем текст заголовка без иконки фильтра
-			var headerText = cell.textContent.replace(/[▼⌘⯆]/g, '').trim();
-			headers.push(headerText);
-			visibleColumnIndexes.push(j);
+	var headers = table.tHead.rows[0].cells;
+
+	// Только видимые столбцы (индекс заголовка смещён на столбец с чекбоксами)
+	var columns = tableColumns.filter(function(column, index) {
+		return !headers[index + 1].classList.contains('hidden-column');
+	});
+
+	var fields = {
+		columns: JSON.stringify(columns),
+		sort: sortState.column,
+		order: sortState.ascending ? 'asc' : 'desc'
+	};
+
+	if (allRows) {
+		fields.filters = JSON.stringify(currentFilters());
+	} else {
+		var serialIndex = tableColumns.indexOf('serialNumber') + 1;
+		var serials = [];
+		var rows = table.tBodies[0].rows;
+		for (var i = 0; i < rows.length; i++) {
+			var checkbox = rows[i].querySelector('input[type="checkbox"]');
+			if (checkbox && checkbox.checked) {
+				serials.push(rows[i].cells[serialIndex].textContent);
+			}
 		}
-	}
-	csvContent += headers.join(";") + "\r\n";;
-
-	// Добавляем выбранные строки данных, только для видимых столбцов
-	for (var i = 1; i < rows.length; i++) {
-		var row = rows[i];
-		var checkbox = row.querySelector('input[type="checkbox"]');
-		if (checkbox && checkbox.checked) {
-			var rowData = [];
-			// Используем только индексы видимых столбцов
-			visibleColumnIndexes.forEach(function(columnIndex) {
-				rowData.push(row.cells[columnIndex].innerText);
-			});
-			csvContent += rowData.join(";") + "\r\n";
+		if (serials.length === 0) {
+			alert('Не выбрано ни одной записи');
+			return;
 		}
+		fields.serials = JSON.stringify(serials);
 	}
 
-	var encodedUri = encodeURI(csvContent);
-	var link = document.createElement("a");
-	link.setAttribute("href", encodedUri);
-	link.setAttribute("download", "selected_data.csv");
-	document.body.appendChild(link);
-	link.click();
-	document.body.removeChild(link);
+	submitExport(fields);
+}
+
+// Отправляет параметры выгрузки обычной формой, чтобы браузер сохранял ответ сразу в файл
+function submitExport(fields) {
+	var form = document.createElement("form");
+	form.method = "POST";
+	form.action = exportUrl;
+
+	Object.keys(fields).forEach(function(name) {
+		var input = document.createElement("input");
+		input.type = "hidden";
+		input.name = name;
+		input.value = fields[name];
+		form.appendChild(input);
+	});
+
+	document.body.appendChild(form);
+	form.submit();
+	document.body.removeChild(form);
 }
 
 function toggleCheckboxes(masterCheckbox) {
@@ -115,7 +246,7 @@ function toggleCheckboxes(masterCheckbox) {
 }
 
 window.onload = function() {
-	updateRowCounter(); // Обновляем счётчик строк при загрузке страницы
+	loadPage(true); // Загружаем первую страницу после применения видимости столбцов
 };
 // Добавляем новые функции для работы с контекстным меню
 document.addEventListener('DOMContentLoaded', function() {
@@ -313,49 +444,41 @@ document.addEventListener('click', function(e) {
 });
 });
 
-document.addEventListener('DOMContentLoaded', function() {
-	// Найти все ячейки с данными о лицензиях
-	const licenseCells = document.querySelectorAll('td a[onclick*="downloadTXT"]');
-	
-	licenseCells.forEach(function(cell) {
-		// Получить данные о лицензиях
-		const onclick = cell.getAttribute('onclick');
-		const licenseData = onclick.split("'")[1]; // Извлекаем JSON-строку из onclick
+// Добавляет рядом со ссылкой на лицензии индикатор наличия действующей лицензии 17
+function addLicenseIndicator(cell, licenseData) {
+	try {
+		const licenses = JSON.parse(licenseData);
+		// Проверяем наличие лицензии 17
+		const hasLicense17 = licenses.hasOwnProperty('17');
 		
-		try {
-			const licenses = JSON.parse(licenseData);
-			// Проверяем наличие лицензии 17
-			const hasLicense17 = licenses.hasOwnProperty('17');
-			
-			// Проверяем срок действия лицензии 17, если она есть
-			let licenseValid = false;
-			if (hasLicense17) {
-				const dateUntil = new Date(licenses['17'].dateUntil);
-				const today = new Date();
-				licenseValid = dateUntil >= today;
-			}
-			
-			// Создаем элемент индикатора
-			const indicator = document.createElement('span');
-			indicator.style.marginLeft = '5px';
-			
-			if (hasLicense17 && licenseValid) {
-				// Лицензия 17 существует и не просрочена
-				indicator.innerHTML = '✔️';
-				indicator.style.color = 'green';
-			} else {
-				// Лицензия 17 отсутствует или просрочена
-				indicator.innerHTML = '❌';
-				indicator.style.color = 'red';
-			}
-			
-			// Добавляем индикатор рядом с ссылкой
-			cell.parentNode.appendChild(indicator);
-		} catch (e) {
-			console.error('Ошибка при разборе данных о лицензиях:', e);
+		// Проверяем срок действия лицензии 17, если она есть
+		let licenseValid = false;
+		if (hasLicense17) {
+			const dateUntil = new Date(licenses['17'].dateUntil);
+			const today = new Date();
+			licenseValid = dateUntil >= today;
 		}
-	});
-});
+		
+		// Создаем элемент индикатора
+		const indicator = document.createElement('span');
+		indicator.style.marginLeft = '5px';
+		
+		if (hasLicense17 && licenseValid) {
+			// Лицензия 17 существует и не просрочена
+			indicator.innerHTML = '✔️';
+			indicator.style.color = 'green';
+		} else {
+			// Лицензия 17 отсутствует или просрочена
+			indicator.innerHTML = '❌';
+			indicator.style.color = 'red';
+		}
+		
+		// Добавляем индикатор рядом с ссылкой
+		cell.appendChild(indicator);
+	} catch (e) {
+		console.error('Ошибка при разборе данных о лицензиях:', e);
+	}
+}
 
 // Объект для хранения текущих фильтров
 const activeFilters = {};
@@ -434,7 +557,6 @@ function applyFilter() {
     }
     
     hideFilterMenu();
-    updateRowCounter(); // Обновляем счётчик строк
 }
 
 // Функция сброса текущего фильтра
@@ -454,45 +576,11 @@ function clearFilter() {
     }
     
     hideFilterMenu();
-    updateRowCounter(); // Обновляем счётчик строк
 }
 
-// Функция применения всех активных фильтров
+// Функция применения всех активных фильтров: строки заново запрашиваются с сервера
 function applyAllFilters() {
-    const table = document.getElementById('data-table');
-    const rows = table.querySelectorAll('tbody tr');
-    
-    rows.forEach(row => {
-        let shouldShow = true;
-        
-        // Проверяем каждый активный фильтр
-        Object.keys(activeFilters).forEach(columnIndex => {
-            const filter = activeFilters[columnIndex];
-            const cellText = row.cells[parseInt(columnIndex)].textContent.toLowerCase();
-            
-            if (filter.type === 'include') {
-                // Включающий фильтр
-                if (!cellText.includes(filter.text)) {
-                    shouldShow = false;
-                }
-            } else {
-                // Исключающий фильтр
-                if (cellText.includes(filter.text)) {
-                    shouldShow = false;
-                }
-            }
-        });
-        
-        // Показываем или скрываем строку
-        row.classList.toggle('filtered-out', !shouldShow);
-    });
-}
-
-// Обновляем функцию обновления счётчика строк
-function updateRowCounter() {
-    var table = document.getElementById("data-table");
-    var visibleRows = table.querySelectorAll('tbody tr:not(.filtered-out)').length;
-    document.getElementById("row-counter").innerText = " " + visibleRows;
+    reloadTable();
 }
 
 // Закрываем фильтр-меню при клике вне его
@@ -38,4 +38,41 @@ function submitForm(action) {
 	const form = document.getElementById('searchForm');
 	form.action = action;
 	form.submit();
+}
+
+let suggestTimer = null;
+let suggestRequestId = 0;
+
+function suggestSearch(input) {
+	// Подсказки запрашиваются с небольшой задержкой, чтобы не отправлять запрос на каждый символ
+	clearTimeout(suggestTimer);
+	const query = input.value.trim();
+	const list = document.getElementById('search-suggestions');
+
+	if (query.length < 2 || query.includes(':')) {
+		list.innerHTML = '';
+		return;
+	}
+
+	suggestTimer = setTimeout(() => {
+		const requestId = ++suggestRequestId;
+
+		fetch('/api/suggest?q=' + encodeURIComponent(query))
+		.then(response => response.json())
+		.then(data => {
+			// Ответ на устаревший запрос не показываем
+			if (requestId !== suggestRequestId) return;
+
+			list.innerHTML = '';
+			(data.suggestions || []).forEach(item => {
+				const option = document.createElement('option');
+				option.value = item.query;
+				option.label = `${item.value} (${item.field})`;
+				list.appendChild(option);
+			});
+		})
+		.catch(error => {
+			console.error('Ошибка:', error);
+		});
+	}, 150);
 }
\ No newline at end of file
@@ -68,47 +68,61 @@ function downloadTXT(data, filename) {
 	URL.revokeObjectURL(url); // Освобождаем память, удаляя URL
 }
 
-// Функция для генерации и загрузки CSV-файла
+// Выгрузка CSV формируется на сервере по списку серийных номеров выбранных строк
 function downloadCSV() {
 	var table = document.getElementById("data-table");
 	var rows = table.rows;
-	var csvContent = "data:text/csv;charset=utf-8,";
 
 	// Получаем только видимые заголовки (начиная с индекса 1, чтобы пропустить столбец с чекбоксами)
-	var headers = [];
-	var visibleColumnIndexes = []; // Сохраняем индексы видимых столбцов
+	var columns = [];
+	var serialIndex = -1;
 	for (var j = 1; j < rows[0].cells.length; j++) {
 		var cell = rows[0].cells[j];
+		// Извлекаем текст заголовка без иконки фильтра
+		var headerText = cell.textContent.replace(/[▼⌘⯆]/g, '').trim();
+		if (headerText === 'serialNumber') {
+			serialIndex = j;
+		}
 		if (!cell.classList.contains('hidden-column')) {
-			// Извлекаем текст заголовка без иконки фильтра
-			var headerText = cell.textContent.replace(/[▼⌘⯆]/g, '').trim();
-			headers.push(headerText);
-			visibleColumnIndexes.push(j);
+			columns.push(headerText);
 		}
 	}
-	csvContent += headers.join(";") + "\r\n";;
 
-	// Добавляем выбранные строки данных, только для видимых столбцов
+	var serials = [];
 	for (var i = 1; i < rows.length; i++) {
-		var row = rows[i];
-		var checkbox = row.querySelector('input[type="checkbox"]');
-		if (checkbox && checkbox.checked) {
-			var rowData = [];
-			// Используем только индексы видимых столбцов
-			visibleColumnIndexes.forEach(function(columnIndex) {
-				rowData.push(row.cells[columnIndex].innerText);
-			});
-			csvContent += rowData.join(";") + "\r\n";
+		var checkbox = rows[i].querySelector('input[type="checkbox"]');
+		if (checkbox && checkbox.checked && serialIndex !== -1) {
+			serials.push(rows[i].cells[serialIndex].textContent.trim());
 		}
 	}
+	if (serials.length === 0) {
+		alert('Не выбрано ни одной записи');
+		return;
+	}
+
+	submitExport({
+		columns: JSON.stringify(columns),
+		serials: JSON.stringify(serials)
+	});
+}
+
+// Отправляет параметры выгрузки обычной формой, чтобы браузер сохранял ответ сразу в файл
+function submitExport(fields) {
+	var form = document.createElement("form");
+	form.method = "POST";
+	form.action = exportUrl;
+
+	Object.keys(fields).forEach(function(name) {
+		var input = document.createElement("input");
+		input.type = "hidden";
+		input.name = name;
+		input.value = fields[name];
+		form.appendChild(input);
+	});
 
-	var encodedUri = encodeURI(csvContent);
-	var link = document.createElement("a");
-	link.setAttribute("href", encodedUri);
-	link.setAttribute("download", "selected_data.csv");
-	document.body.appendChild(link);
-	link.click();
-	document.body.removeChild(link);
+	document.body.appendChild(form);
+	form.submit();
+	document.body.removeChild(form);
 }
 
 // Добавляем новые функции для работы с контекстным меню
